@@ -0,0 +1,105 @@
+import argparse
+import random
+import sys
+import pandas as pd
+from benchmarks.fixtures import make_slate, market_frame, move_lines
+from nba.nba_helper_functions import RLM_MARKETS, decimal_to_american, detect_reverse_line_movements
+from nba.nba_quotes import REFERENCE_BOOKS, align_quotes, snapshot_to_quotes
+
+# (money, disagreement) thresholds the vectorized detection is compared at, the live ones included
+THRESHOLDS = [(0.5, 0.4), (0.3, 0.2), (0.7, 0.1)]
+
+
+def rowwise_detection(merged, market, books, money_threshold, disagreement_threshold):
+    # The row by row loop the detection ran before it was vectorized, over the merged wide snapshots: per team,
+    # the book with the best odds among those that moved against the money, and the first quoted book when money
+    # and bets disagree. On spreads and totals it also needed an "unchanged" book inside the moved branch.
+    value = 'odds' if market == 'moneyline' else market
+    rlm, disagreements = set(), set()
+    for _, row in merged.iterrows():
+        money_pc, bets_pc = row['money_pc_new'], row['bets_pc_new']
+        if pd.isnull(money_pc):
+            continue
+        unchanged_books = []
+        best_value = best_book = best_line = None
+        first = None
+        for book in books:
+            old_key, new_key = f'{book}_{value}_old', f'{book}_{value}_new'
+            if old_key not in row or new_key not in row or pd.isnull(row[old_key]) or pd.isnull(row[new_key]):
+                continue
+            old_line, new_line = row[old_key], row[new_key]
+            new_odds = row[f'{book}_odds_new']
+            if (money_pc > money_threshold and new_line > old_line) or \
+                    (money_pc < money_threshold and new_line < old_line):
+                if old_line == new_line:
+                    unchanged_books.append(book)
+                if best_value is None or new_odds > best_value:
+                    best_value, best_book, best_line = new_odds, book, new_line
+            if first is None and money_pc - bets_pc > disagreement_threshold:
+                first = (book, new_line, new_odds)
+        if first is not None:
+            disagreements.add(flagged(row['game_id'], row['team'], *first, market))
+        if best_book is not None and (market == 'moneyline' or unchanged_books):
+            rlm.add(flagged(row['game_id'], row['team'], best_book, best_line, best_value, market))
+    return rlm, disagreements
+
+
+def flagged(game_id, team, book, line, odds, market):
+    # Moneyline alerts report the American price in place of the line
+    line = round(decimal_to_american(odds)) if market == 'moneyline' else round(float(line), 2)
+    return str(game_id), str(team), str(book), line, round(float(odds), 2)
+
+
+def vectorized_detection(old, new, market, money_threshold, disagreement_threshold):
+    aligned = align_quotes(snapshot_to_quotes(old, market), snapshot_to_quotes(new, market))
+    rlm_opportunities, disagreement_opportunities = detect_reverse_line_movements(
+        aligned, market, money_threshold, disagreement_threshold)
+    rlm = {flagged(o['game_id'], o['team'], o['best_value_bookmaker'], o['line'], o['best_value_odds'], 'spread')
+           for o in rlm_opportunities}
+    disagreements = {flagged(o['game_id'], o['team'], o['bookmaker'], o['line'], o['odds'], 'spread')
+                     for o in disagreement_opportunities}
+    return rlm, disagreements
+
+
+def check(seeds=range(5), games=15, books=40, probability=0.3):
+    # Both detections on consecutive polls of fixture slates, every market and threshold pair; returns the
+    # mismatches and how many rows each kind flagged
+    mismatches = []
+    totals = {'rlm': 0, 'disagreement': 0}
+    for seed in seeds:
+        slate = make_slate(games, books, seed)
+        old = {market: market_frame(slate, market) for market in ('spread', 'total', 'moneyline')}
+        move_lines(slate, random.Random(seed), probability)
+        new = {market: market_frame(slate, market) for market in old}
+        # The quoted books, reference columns are not bookmakers we can bet with
+        bookmakers = [book for book in slate[0]['books'] if book not in REFERENCE_BOOKS]
+        for market in old:
+            merged = old[market].merge(new[market], on=['game_id', 'team'], suffixes=('_old', '_new'))
+            for money_threshold, disagreement_threshold in THRESHOLDS:
+                expected = rowwise_detection(merged, market, bookmakers, money_threshold, disagreement_threshold)
+                actual = vectorized_detection(old[market], new[market], market, money_threshold,
+                                              disagreement_threshold)
+                for kind, rows, vector_rows in zip(('rlm', 'disagreement'), expected, actual):
+                    totals[kind] += len(rows)
+                    if rows != vector_rows:
+                        mismatches.append({'seed': seed, 'market': market, 'kind': kind,
+                                           'thresholds': (money_threshold, disagreement_threshold),
+                                           'rowwise_only': sorted(rows - vector_rows),
+                                           'vectorized_only': sorted(vector_rows - rows)})
+    return mismatches, totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the vectorized detection with the row by row loop on '
+                                                 'fixture slates')
+    parser.add_argument('--seeds', type=int, default=5)
+    parser.add_argument('--games', type=int, default=15)
+    parser.add_argument('--books', type=int, default=40)
+    args = parser.parse_args()
+
+    mismatches, totals = check(range(args.seeds), args.games, args.books)
+    for mismatch in mismatches:
+        print(f"Mismatch: {mismatch}")
+    print(f"{totals['rlm']} reverse line movements ({', '.join(RLM_MARKETS)} only) and {totals['disagreement']} "
+          f"disagreements flagged by the row by row loop, {len(mismatches)} mismatches")
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,54 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from benchmarks.fixtures import load_fixture_pages
+
+
+class FixtureServer:
+    # Local stand-in for the odds site, serving url path -> HTML from memory. Pages can be swapped
+    # while it runs (e.g. to move lines between polls) and every request is counted.
+
+    def __init__(self, pages=None, host='127.0.0.1', port=0):
+        self.pages = pages if pages is not None else load_fixture_pages()
+        self.requests = 0
+        self.bytes_sent = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                html = server.pages.get(path) or server.pages.get(path.rstrip('/') + '/')
+                server.requests += 1
+                if html is None:
+                    self.send_error(404)
+                    return
+                body = html.encode() if isinstance(html, str) else html
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                server.bytes_sent += len(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def url(self, path):
+        return self.base_url + path
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
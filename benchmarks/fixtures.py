@@ -0,0 +1,261 @@
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+from html import escape
+import pandas as pd
+import pytz
+from nba.nba_helper_functions import american_to_decimal
+from nba.nba_quotes import game_key
+
+# The pages are rendered from the parser's own selectors, not recorded from the site: they time the parser offline
+# and keep it working on pages of that shape, but cannot tell when the site's markup has drifted from it
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+OVERVIEW_PATH = '/nba/odds/las-vegas/'
+MATCHUP_PATH = '/nba/odds/matchup/{slug}/'
+
+TEAMS = ['Atlanta Hawks', 'Boston Celtics', 'Brooklyn Nets', 'Charlotte Hornets', 'Chicago Bulls',
+         'Cleveland Cavaliers', 'Dallas Mavericks', 'Denver Nuggets', 'Detroit Pistons', 'Golden State Warriors',
+         'Houston Rockets', 'Indiana Pacers', 'Los Angeles Clippers', 'Los Angeles Lakers', 'Memphis Grizzlies',
+         'Miami Heat', 'Milwaukee Bucks', 'Minnesota Timberwolves', 'New Orleans Pelicans', 'New York Knicks',
+         'Oklahoma City Thunder', 'Orlando Magic', 'Philadelphia 76ers', 'Phoenix Suns', 'Portland Trail Blazers',
+         'Sacramento Kings', 'San Antonio Spurs', 'Toronto Raptors', 'Utah Jazz', 'Washington Wizards']
+NAMED_BOOKS = ['Open', 'Consensus', 'BetMGM', 'Caesars', 'DraftKings', 'FanDuel', 'BetRivers', 'Bet365',
+               'PointsBet', 'Unibet', 'WynnBET', 'Circa']
+
+
+def make_bookmakers(books):
+    return (NAMED_BOOKS + [f'Book{i:02d}' for i in range(books)])[:books]
+
+
+def american(price):
+    price = int(round(price))
+    if -100 < price < 100:
+        price = 100 if price >= 0 else -100
+    return price
+
+
+def make_slate(games=15, books=40, seed=7, start=None):
+    # A deterministic slate of games with spread, total and moneyline quotes per book
+    rng = random.Random(seed)
+    start = start or datetime(2030, 1, 15, 0, 0, tzinfo=pytz.utc)
+    bookmakers = make_bookmakers(books)
+    teams = TEAMS[:]
+    rng.shuffle(teams)
+    slate = []
+    for g in range(games):
+        away, home = teams[(2 * g) % len(teams)], teams[(2 * g + 1) % len(teams)]
+        spread = rng.choice([0.5, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5, 9.5, 11.5])
+        total = rng.choice([210.5, 215.5, 220.5, 225.5, 230.5, 235.5])
+        game = {
+            'slug': f'{away}-vs-{home}-{g}'.lower().replace(' ', '-'),
+            'teams': [away, home],
+            'time': start + timedelta(minutes=30 * g),
+            'books': bookmakers,
+            'quotes': {'spread': [], 'total': [], 'moneyline': []},
+            'bets_pc': {market: rng.randint(20, 80) for market in ('spread', 'total', 'moneyline')},
+            'money_pc': {market: rng.randint(10, 90) for market in ('spread', 'total', 'moneyline')},
+        }
+        favourite_price = american(-110 - 12 * spread)
+        for _ in bookmakers:
+            # Roughly one book in ten has no quote
+            if rng.random() < 0.1:
+                for market in game['quotes']:
+                    game['quotes'][market].append(None)
+                continue
+            line = spread + rng.choice([-0.5, 0, 0, 0, 0.5])
+            points = total + rng.choice([-1, 0, 0, 0, 1])
+            game['quotes']['spread'].append([line, american(rng.choice([-115, -110, -110, -105])),
+                                             american(rng.choice([-115, -110, -110, -105]))])
+            game['quotes']['total'].append([points, american(rng.choice([-115, -110, -105])),
+                                            american(rng.choice([-115, -110, -105]))])
+            game['quotes']['moneyline'].append([None, american(favourite_price + rng.randint(-15, 15)),
+                                                american(-favourite_price - 20 + rng.randint(-15, 15))])
+        slate.append(game)
+    return slate
+
+
+def move_lines(slate, rng, probability=0.05):
+    # Random walk: every quote moves half a point (and its price) with the given probability
+    for game in slate:
+        for market, quotes in game['quotes'].items():
+            for quote in quotes:
+                if quote is None or rng.random() >= probability:
+                    continue
+                if quote[0] is not None:
+                    quote[0] += rng.choice([-0.5, 0.5])
+                quote[1] = american(quote[1] + rng.choice([-5, 5]))
+                quote[2] = american(quote[2] + rng.choice([-5, 5]))
+        for market in game['money_pc']:
+            if rng.random() < probability:
+                game['money_pc'][market] = min(99, max(1, game['money_pc'][market] + rng.randint(-5, 5)))
+    return slate
+
+
+def format_line(market, line, team_index):
+    if market == 'total':
+        return f"{'o' if team_index == 0 else 'u'}{line:g}"
+    signed = -line if team_index == 1 else line
+    return f'{signed:+g}'
+
+
+def format_price(price):
+    return 'even' if price == 100 else f'{price:+d}'
+
+
+def render_odds_table(game, market):
+    table_id = f'odds-table-{market}--0'
+    header = ''.join(f'<th class="book-logo"><img alt="{escape(book)}" src="/logos/{i}.png"></th>'
+                     for i, book in enumerate(game['books']))
+    rows = [f'<tr><th>Team</th>{header}</tr>']
+    for team_index, (row_class, team) in enumerate(zip(['divided', 'footer'], game['teams'])):
+        cells = []
+        for quote in game['quotes'][market]:
+            if quote is None:
+                value = '<span class="data-moneyline">N/A</span>' if market == 'moneyline' else \
+                    '<span class="data-value">N/A</span><span class="data-odds">N/A</span>'
+            elif market == 'moneyline':
+                value = f'<span class="data-moneyline">{format_price(quote[1 + team_index])}</span>'
+            else:
+                value = (f'<span class="data-value">{format_line(market, quote[0], team_index)}</span>'
+                         f'<span class="data-odds">{format_price(quote[1 + team_index])}</span>')
+            cells.append(f'<td class="game-odds"><a>{value}</a></td>')
+        rows.append(f'<tr class="{row_class}"><td class="game-team"><div><img alt="{escape(team)}"></div></td>'
+                    f'{"".join(cells)}</tr>')
+    return f'<table><tbody id="{table_id}">{"".join(rows)}</tbody></table>'
+
+
+def render_trends_table(game, kind):
+    values = game[f'{kind}_pc']
+    rows = ['<tr><th>Team</th><th>Spread</th><th>Total</th><th>Moneyline</th></tr>']
+    for team_index, team in enumerate(game['teams']):
+        pcs = [values[market] if team_index == 0 else 100 - values[market]
+               for market in ('spread', 'total', 'moneyline')]
+        if kind == 'bets':
+            cells = f'<td><div>{pcs[0]}%</div></td><td><div>{pcs[1]}%</div></td><td>{pcs[2]}%</td>'
+        else:
+            cells = ''.join(f'<td>{pc}%</td>' for pc in pcs)
+        rows.append(f'<tr><td>{escape(team)}</td>{cells}</tr>')
+    return f'<table><tbody id="trends-table-{kind}--0">{"".join(rows)}</tbody></table>'
+
+
+def render_matchup(game):
+    iso = game['time'].strftime('%Y-%m-%dT%H:%M:%SZ')
+    return (
+        '<!DOCTYPE html><html><head><title>' + escape(' @ '.join(game['teams'])) + '</title></head><body>'
+        '<header><div class="page-social"><span>Sign in</span></div></header>'
+        '<div class="event-header module"><div><div><div class="event-header-score"><div><span>'
+        f'<span>{game["time"]:%b %d}</span><span data-value="{iso}">{game["time"]:%I:%M %p}</span>'
+        '</span></div></div></div></div></div>'
+        '<div id="odds-component"><div><ul><li>Las Vegas</li></ul><ul><li><span>Spread</span></li>'
+        '<li><span data-role="openable" data-anchor="#total">Total</span></li><li><span>Moneyline</span></li></ul>'
+        '</div></div>'
+        + render_odds_table(game, 'spread') + render_odds_table(game, 'total')
+        + render_odds_table(game, 'moneyline') +
+        '<div id="trends-component"><div><ul><li><span>Bets</span></li><li><span>Money</span></li></ul><div>'
+        + render_trends_table(game, 'bets') + render_trends_table(game, 'money') +
+        '</div></div></div></body></html>'
+    )
+
+
+def render_overview(slate):
+    game = slate[0]
+    header = ''.join(f'<th class="book-logo"><img alt="{escape(book)}"></th>' for book in game['books'])
+    rows = [f'<tr><th>Game</th>{header}<th></th></tr>']
+    for game in slate:
+        for team_index, (row_class, team) in enumerate(zip(['divided', 'footer'], game['teams'])):
+            cells = []
+            for quote in game['quotes']['spread']:
+                if quote is None:
+                    cells.append('<td class="game-odds"><span class="data-value">N/A</span></td>')
+                else:
+                    cells.append(f'<td class="game-odds"><span class="data-value">'
+                                 f'{format_line("spread", quote[0], team_index)}</span><span class="data-odds">'
+                                 f'{format_price(quote[1 + team_index])}</span></td>')
+            links = ''
+            if team_index == 0:
+                links = ('<td class="game-links" rowspan="2"><ul class="nav"><li class="nav-item buttons">'
+                         f'<a class="button matte rounded" href="{MATCHUP_PATH.format(slug=game["slug"])}">Matchup</a>'
+                         '</li></ul></td>')
+            rows.append(f'<tr class="{row_class}"><td class="game-team"><div><img alt="{escape(team)}"></div></td>'
+                        f'{"".join(cells)}{links}</tr>')
+    return ('<!DOCTYPE html><html><head><title>NBA Odds</title></head><body>'
+            f'<table><tbody id="odds-table-spread--0">{"".join(rows)}</tbody></table></body></html>')
+
+
+def slate_pages(slate):
+    # Url path -> HTML of the overview and every matchup page
+    pages = {OVERVIEW_PATH: render_overview(slate)}
+    for game in slate:
+        pages[MATCHUP_PATH.format(slug=game['slug'])] = render_matchup(game)
+    return pages
+
+
+def market_frame(slate, market):
+    # The wide snapshot the scraper would return for one market of this slate, without rendering any HTML.
+    # Moneyline quotes have no line, only a {book}_odds column per book.
+    records = []
+    for game in slate:
+        for team_index, team in enumerate(game['teams']):
+            pcs = {kind: (game[f'{kind}_pc'][market] if team_index == 0 else 100 - game[f'{kind}_pc'][market])
+                   / 100 for kind in ('bets', 'money')}
+            record = {'game_id': game_key(game['time'], game['teams']), 'time': game['time'], 'team': team,
+                      'bets_pc': pcs['bets'], 'money_pc': pcs['money']}
+            for book, quote in zip(game['books'], game['quotes'][market]):
+                # Unquoted books keep their empty columns, as the parser writes them
+                if quote is None:
+                    if market != 'moneyline':
+                        record[f'{book}_{market}'] = None
+                    record[f'{book}_odds'] = None
+                    continue
+                if market != 'moneyline':
+                    line = quote[0] if market == 'total' else (-quote[0] if team_index == 1 else quote[0])
+                    record[f'{book}_{market}'] = float(line) if market == 'spread' else \
+                        float(line if team_index == 0 else -line)
+                record[f'{book}_odds'] = american_to_decimal(quote[1 + team_index])
+            records.append(record)
+    return pd.DataFrame(records)
+
+
+def slate_frames(slate):
+    # The spread and total snapshots the scraper would return for this slate
+    return market_frame(slate, 'spread'), market_frame(slate, 'total'), list(slate[0]['books']), \
+        list(slate[0]['books'])
+
+
+def fixture_file(path):
+    if path == OVERVIEW_PATH:
+        return 'overview.html'
+    return 'matchup-' + path.rstrip('/').rsplit('/', 1)[-1] + '.html'
+
+
+def write_fixtures(directory=FIXTURES_DIR, slate=None):
+    slate = slate or make_slate()
+    os.makedirs(directory, exist_ok=True)
+    for path, html in slate_pages(slate).items():
+        with open(os.path.join(directory, fixture_file(path)), 'w') as file:
+            file.write(html)
+    return slate
+
+
+def load_fixture_pages(directory=FIXTURES_DIR):
+    # Url path -> HTML of the saved fixtures
+    pages = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name)) as file:
+            html = file.read()
+        if name == 'overview.html':
+            pages[OVERVIEW_PATH] = html
+        elif name.startswith('matchup-'):
+            pages[MATCHUP_PATH.format(slug=name[len('matchup-'):-len('.html')])] = html
+    return pages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Regenerate the saved overview and matchup page fixtures')
+    parser.add_argument('--games', type=int, default=15)
+    parser.add_argument('--books', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--directory', default=FIXTURES_DIR)
+    args = parser.parse_args()
+    write_fixtures(args.directory, make_slate(args.games, args.books, args.seed))
@@ -0,0 +1,189 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+import requests
+from benchmarks.fixture_server import FixtureServer
+from benchmarks.fixtures import OVERVIEW_PATH, load_fixture_pages, make_slate, move_lines, slate_frames
+from nba.nba_helper_functions import detect_reverse_line_movements, detect_and_accumulate
+from nba.nba_http import HttpSession
+from nba.nba_notified import NotifiedStore
+from nba.nba_parser import parse_game_snapshots, parse_game_urls
+from nba.nba_prices import BestPriceIndex
+from nba.nba_quotes import align_quotes, snapshot_to_quotes
+from nba.nba_tracker import MovementTracker
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def measure(name, func, repeat, items=1):
+    # Timed runs first, then one run under tracemalloc for the peak memory
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        'runs': repeat,
+        'items': items,
+        'p50_ms': round(statistics.median(timings) * 1000, 3),
+        'p95_ms': round(percentile(timings, 95) * 1000, 3),
+        'throughput_per_s': round(items / statistics.median(timings), 1),
+        'peak_kb': round(peak / 1024, 1),
+    }
+    print(f"{name:<30} p50 {result['p50_ms']:>10.3f} ms  p95 {result['p95_ms']:>10.3f} ms  "
+          f"{result['throughput_per_s']:>10.1f} items/s  peak {result['peak_kb']:>9.1f} KB")
+    return result
+
+
+def slate_quotes(games, books, seed):
+    # Previous and current synthetic spread quotes, in the long format scheduled_job aligns
+    slate = make_slate(games, books, seed)
+    old_spread, _, _, _ = slate_frames(slate)
+    move_lines(slate, random.Random(seed), probability=0.2)
+    new_spread, _, _, _ = slate_frames(slate)
+    return old_spread, snapshot_to_quotes(old_spread, 'spread'), snapshot_to_quotes(new_spread, 'spread')
+
+
+def run(repeat=20, games=15, books=40, seed=7, browser=False):
+    results = {}
+    pages = load_fixture_pages()
+    matchup_pages = [html for path, html in pages.items() if path != OVERVIEW_PATH]
+
+    # Extraction, offline from the saved fixtures
+    results['parse_overview'] = measure('parse_overview', lambda: parse_game_urls(pages[OVERVIEW_PATH]), repeat)
+    results['parse_game'] = measure(
+        'parse_game', lambda: [parse_game_snapshots({'bets': html}) for html in matchup_pages], repeat,
+        items=len(matchup_pages))
+
+    # Extraction through the local stand-in server
+    with FixtureServer(pages) as server:
+        session = requests.Session()
+        urls = [server.url(path) for path in pages if path != OVERVIEW_PATH]
+        results['http_fetch_parse_game'] = measure(
+            'http_fetch_parse_game', lambda: [parse_game_snapshots({'bets': session.get(url).text}) for url in urls],
+            max(1, repeat // 4), items=len(urls))
+
+        # The HTTP backend: concurrent fetches through one pooled client, no login against the stand-in
+        http_session = HttpSession(server.base_url + '/', OVERVIEW_PATH.lstrip('/'), None, None, cookies={},
+                                   cookies_file=os.path.join(tempfile.gettempdir(), 'benchmark_cookies.json'))
+        results['http_session_scrape'] = measure(
+            'http_session_scrape', lambda: http_session.scrape_games(http_session.list_games()), max(1, repeat // 4),
+            items=len(urls))
+        http_session.close()
+
+        if browser:
+            from nba.nba_game import extract_game_data
+            from nba.nba_helper_functions import initialize_webdriver
+            # The default profile, then the lean one that blocks images, fonts and trackers
+            for lean, name in ((False, 'browser_extract_game_data'), (True, 'browser_extract_game_data_lean')):
+                driver = initialize_webdriver(lean)
+                try:
+                    results[name] = measure(name, lambda: [extract_game_data(driver, url) for url in urls], 1,
+                                            items=len(urls))
+                finally:
+                    driver.quit()
+
+    # Detection and alerting on synthetic slates
+    wide_spread, old_quotes, new_quotes = slate_quotes(games, books, seed)
+    results['merge'] = measure('merge', lambda: align_quotes(old_quotes, new_quotes), repeat)
+    aligned = align_quotes(old_quotes, new_quotes)
+    results['detect_reverse_line_movements'] = measure(
+        'detect_reverse_line_movements', lambda: detect_reverse_line_movements(aligned, 'spread'), repeat,
+        items=len(aligned))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'notified_movements.csv')
+        results['detect_and_accumulate'] = measure(
+            'detect_and_accumulate', lambda: detect_and_accumulate(aligned, 'spread', NotifiedStore(path)),
+            repeat, items=len(aligned))
+
+    # The daemon's per-book history: one poll pushed, then the windowed movement of every tracked book
+    tracker = MovementTracker()
+    tracker.update(old_quotes.assign(scrape_ts=pd.Timestamp('2030-01-14', tz='UTC')))
+    results['tracker_update'] = measure('tracker_update', lambda: tracker.update(new_quotes.assign(
+        scrape_ts=pd.Timestamp('2030-01-14 00:01', tz='UTC'))), repeat, items=len(new_quotes))
+    results['tracker_movement_within'] = measure(
+        'tracker_movement_within', lambda: tracker.movement_within(10, pd.Timestamp('2030-01-14 00:05', tz='UTC')),
+        repeat, items=len(tracker))
+
+    # Best price across books: a slate's quotes moving into the index, then a best-at-line lookup per side
+    prices = BestPriceIndex()
+    prices.update(old_quotes)
+    # Alternating between the two polls, so every call moves the quotes that changed
+    polls = itertools.cycle([new_quotes, old_quotes])
+    results['price_index_update'] = measure('price_index_update', lambda: prices.update(next(polls)), repeat,
+                                            items=len(new_quotes))
+    sides = list(prices.quotes)
+    results['price_index_best'] = measure(
+        'price_index_best', lambda: [prices.best(*side, line=prices.best(*side)[2]) for side in sides], repeat,
+        items=len(sides))
+
+    return {
+        'environment': {'python': platform.python_version(), 'machine': platform.machine(),
+                        'pandas': pd.__version__},
+        'parameters': {'repeat': repeat, 'games': games, 'books': books, 'seed': seed, 'browser': browser},
+        'results': results,
+        # One snapshot of the spread market, wide (a column pair per book) and long (a row per quote)
+        'memory_kb': {'wide_snapshot': round(wide_spread.memory_usage(deep=True).sum() / 1024, 1),
+                      'long_quotes': round(old_quotes.memory_usage(deep=True).sum() / 1024, 1)},
+    }
+
+
+def compare(report, baseline):
+    print('\nCompared with the stored baseline (p50, lower is better):')
+    for name, result in report['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous or not previous['p50_ms']:
+            print(f'{name:<30} no baseline')
+            continue
+        ratio = result['p50_ms'] / previous['p50_ms']
+        print(f"{name:<30} {previous['p50_ms']:>10.3f} -> {result['p50_ms']:>10.3f} ms  x{ratio:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmarks of extraction, merge and detection')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--games', type=int, default=15)
+    parser.add_argument('--books', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--browser', action='store_true',
+                        help='also time extract_game_data in a headless Chromium against the fixture server')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--save-baseline', action='store_true', help=f'store the report as {BASELINE_FILE}')
+    args = parser.parse_args()
+
+    if args.browser and not (shutil.which('chromedriver') or shutil.which('chromium')):
+        print('No Chromium found, the browser benchmark may fail')
+    report = run(args.repeat, args.games, args.books, args.seed, args.browser)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w') as file:
+            json.dump(report, file, indent=2)
+    elif os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as file:
+            compare(report, json.load(file))
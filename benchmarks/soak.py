@@ -0,0 +1,418 @@
+import argparse
+import contextlib
+import gc
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import pytz
+
+# nba_main reads the site credentials at import, the stand-in site does not check them
+os.environ.setdefault('VI_USERNAME', 'soak')
+os.environ.setdefault('VI_PASSWORD', 'soak')
+
+import nba_communications
+import nba_main
+from telegram import Bot
+from benchmarks.fixture_server import FixtureServer
+from benchmarks.fixtures import MATCHUP_PATH, OVERVIEW_PATH, make_slate, move_lines, render_matchup, render_overview
+from nba.nba_driver import process_tree_rss
+from nba.nba_history import HISTORY_DIR
+from nba.nba_http import HTTP_COOKIES_FILE, HttpSession
+from nba.nba_metrics import JSONL_FILE, METRICS, METRICS_DIR, PROMETHEUS_FILE
+from nba.nba_notified import NOTIFIED_MOVEMENTS_FILE
+from nba.nba_polling import OVERVIEW_FINGERPRINTS_FILE
+from nba.nba_tracker import TRACKER_FILE
+
+SOAK_START = datetime(2030, 1, 15, 12, 0, tzinfo=pytz.utc)
+# Slates tip off in the evening and are listed from noon the day before until their last game is over
+FIRST_TIPOFF = timedelta(hours=23)
+LISTED_BEFORE = timedelta(hours=35)
+GAME_LENGTH = timedelta(hours=3)
+TELEGRAM_TOKEN = '123456:soak'
+TELEGRAM_CHAT = '1001'
+
+# Files rewritten every cycle, their size has to level off
+STATE_FILES = {
+    'notified_kb': NOTIFIED_MOVEMENTS_FILE,
+    'fingerprints_kb': OVERVIEW_FINGERPRINTS_FILE,
+    'tracker_kb': TRACKER_FILE,
+    'cookies_kb': HTTP_COOKIES_FILE,
+    'messages_kb': nba_main.MESSAGES_FILE,
+    'unsent_kb': nba_communications.UNSENT_FILE,
+    'prometheus_kb': os.path.join(METRICS_DIR, PROMETHEUS_FILE),
+}
+# Append-only by design: what they gain per day has to level off, not their size
+APPEND_ONLY = {
+    'history_kb': HISTORY_DIR,
+    'metrics_log_kb': os.path.join(METRICS_DIR, JSONL_FILE),
+}
+# Headroom over the earlier days' peak before a metric counts as growing, on top of the relative tolerance
+SLACK = {'rss_mb': 16, 'fds': 4, 'threads': 2}
+
+
+@contextlib.contextmanager
+def patched(target, **attributes):
+    # Module or object attributes replaced for the duration, the originals are put back on exit
+    originals = {name: getattr(target, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(target, name, value)
+    try:
+        yield target
+    finally:
+        for name, value in originals.items():
+            setattr(target, name, value)
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    # Every state file of the pipeline is relative to the working directory
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(previous)
+
+
+class FakeClock:
+    # Simulated wall clock, read by datetime.now() in the pipeline modules while patched in. perf_counter and
+    # monotonic stay real, so latencies are the real ones.
+
+    def __init__(self, start=SOAK_START):
+        self.current = start
+
+    def now(self, tz=None):
+        return self.current.astimezone(tz) if tz else self.current.replace(tzinfo=None)
+
+    def advance(self, seconds):
+        self.current += timedelta(seconds=seconds)
+
+    @contextlib.contextmanager
+    def patched(self):
+        clock = self
+
+        class ClockDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.now(tz)
+
+        modules = [module for name, module in list(sys.modules.items())
+                   if (name == 'nba_main' or name.startswith('nba.')) and getattr(module, 'datetime', None) is datetime]
+        with contextlib.ExitStack() as stack:
+            for module in modules:
+                stack.enter_context(patched(module, datetime=ClockDatetime))
+            yield self
+
+
+class TelegramStub:
+    # Local stand-in for the Bot API, every sendMessage is accepted and counted
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.messages = 0
+        self.characters = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                params = {name: values[0] for name, values in parse_qs(body).items()}
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                if method == 'getMe':
+                    result = {'id': 1, 'is_bot': True, 'first_name': 'Soak', 'username': 'soak_bot'}
+                elif method == 'sendMessage':
+                    stub.messages += 1
+                    stub.characters += len(params.get('text', ''))
+                    result = {'message_id': stub.messages, 'date': int(time.time()), 'text': params.get('text', ''),
+                              'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}}
+                else:
+                    result = True
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def outbox(self):
+        # The real outbox and Bot, pointed at the stub
+        return nba_communications.BackgroundOutbox(
+            TELEGRAM_TOKEN, TELEGRAM_CHAT, bot=Bot(TELEGRAM_TOKEN, base_url=self.base_url))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+class SoakSite:
+    # The odds site over simulated days, served by a FixtureServer: a new slate every day, listed from noon the
+    # day before until its games are over, and some of the listed lines move before every poll
+
+    def __init__(self, server, games=15, books=40, seed=7, move_probability=0.05):
+        self.server = server
+        self.games = games
+        self.books = books
+        self.seed = seed
+        self.move_probability = move_probability
+        self.rng = random.Random(seed)
+        self.slates = {}
+
+    def slate(self, day):
+        if day not in self.slates:
+            start = datetime(day.year, day.month, day.day, tzinfo=pytz.utc) + FIRST_TIPOFF
+            slate = make_slate(self.games, self.books, self.seed + day.toordinal(), start)
+            # Matchup urls are unique per day, as on the site
+            for game in slate:
+                game['slug'] = f"{game['slug']}-{day:%Y%m%d}"
+            self.slates[day] = slate
+        return self.slates[day]
+
+    def listed(self, now):
+        days = [(now - timedelta(days=offset)).date() for offset in (1, 0, -1)]
+        for day in [day for day in self.slates if day < days[0]]:
+            del self.slates[day]
+        return [game for day in sorted(days) for game in self.slate(day)
+                if game['time'] - LISTED_BEFORE <= now < game['time'] + GAME_LENGTH]
+
+    def publish(self, now):
+        games = move_lines(self.listed(now), self.rng, self.move_probability)
+        pages = {MATCHUP_PATH.format(slug=game['slug']): render_matchup(game) for game in games}
+        pages[OVERVIEW_PATH] = render_overview(games)
+        self.server.pages = pages
+        return len(games)
+
+
+def tree_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            with contextlib.suppress(OSError):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def daemon_sizes(daemon):
+    # Entries held in memory between polls
+    return {
+        'notified': len(daemon.notified_movements),
+        'notified_heap': len(daemon.notified_movements.expiry_heap),
+        'tracker_rows': len(daemon.tracker),
+        'tracker_capacity': daemon.tracker.capacity,
+        'price_books': len(daemon.prices),
+        'scheduled_games': len(daemon.polling.games) + len(daemon.polling.retired),
+        'fingerprints': len(daemon.overview.fingerprints),
+        'previous_rows': sum(len(quotes) for quotes in daemon.previous.values()),
+        'outbox_pending': len(daemon.outbox.pending) if daemon.outbox else 0,
+    }
+
+
+def sample(daemon=None):
+    gc.collect()
+    rss = process_tree_rss(os.getpid())
+    result = {
+        'rss_mb': round(rss / 2 ** 20, 2) if rss is not None else None,
+        'fds': len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None,
+        'threads': threading.active_count(),
+        'metric_series': len(METRICS.stages) + len(METRICS.counters) + len(METRICS.gauges),
+    }
+    for name, path in {**STATE_FILES, **APPEND_ONLY}.items():
+        result[name] = round(tree_size(path) / 1024, 1) if os.path.exists(path) else 0.0
+    if daemon is not None:
+        result.update(daemon_sizes(daemon))
+    return result
+
+
+def window_value(name, values):
+    # Per day: the peak, the median latency, or for append-only files what they gained
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    if name == 'seconds':
+        return statistics.median(values)
+    if name in APPEND_ONLY:
+        return max(values) - min(values)
+    return max(values)
+
+
+def check_growth(samples, warmup_days, tolerance=0.1, latency_tolerance=0.5):
+    # Every metric's last day against the worst of the earlier days: more than that plus the tolerance (and
+    # the metric's slack) is growth without a bound in sight. The traced day is slower by design, it is left out.
+    days = sorted({entry['day'] for entry in samples if entry['day'] >= warmup_days and not entry['traced']})
+    names = [name for name in samples[-1] if name not in ('cycle', 'day', 'traced', 'games')]
+    checks = {}
+    for name in names:
+        windows = [window_value(name, [entry.get(name) for entry in samples if entry['day'] == day]) for day in days]
+        if any(value is None for value in windows):
+            continue
+        earlier, last = max(windows[:-1]), windows[-1]
+        allowed = latency_tolerance if name == 'seconds' else tolerance
+        limit = earlier * (1 + allowed) + SLACK.get(name, 0)
+        checks[name] = {'days': [round(value, 4) for value in windows], 'limit': round(limit, 4),
+                        'ok': last <= limit}
+    return checks
+
+
+def pipeline_traces(snapshot):
+    # Without the harness itself: the stand-in site's pages and the samples are meant to be kept
+    harness = os.path.dirname(os.path.abspath(__file__))
+    return snapshot.filter_traces([tracemalloc.Filter(False, os.path.join(harness, '*')),
+                                   tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def top_allocators(baseline, snapshot, top=10):
+    # Source lines whose allocations of the traced day are still alive at its end, the largest first
+    return [{'where': str(stat.traceback), 'size_diff_kb': round(stat.size_diff / 1024, 1),
+             'count_diff': stat.count_diff} for stat in snapshot.compare_to(baseline, 'lineno')[:top]]
+
+
+def run(mode='daemon', days=8, warmup_days=1, step=600, games=10, books=12, seed=7, move_probability=0.05,
+        directory=None, tolerance=0.1, latency_tolerance=0.5, trace=True, verbose=False):
+    # Polls back to back on the simulated clock, step seconds apart, against the stand-in site and Telegram.
+    # With trace, one more day runs under tracemalloc (about three times slower) for the allocators that hold on
+    # to memory; it is not part of the growth checks.
+    cycles_per_day = int(24 * 3600 // step)
+    total_days = days + 1 if trace else days
+    clock = FakeClock()
+    samples = []
+    with contextlib.ExitStack() as stack:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        else:
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.enter_context(working_directory(directory))
+        server = stack.enter_context(FixtureServer({}))
+        telegram = stack.enter_context(TelegramStub())
+        site = SoakSite(server, games, books, seed, move_probability)
+        quiet = stack.enter_context(open(os.devnull, 'w'))
+        # The stub has no rate limit, the real one would stretch a simulated day into hours
+        stack.enter_context(patched(nba_communications, GLOBAL_RATE=10 ** 6, PRIVATE_CHAT_RATE=10 ** 6))
+        stack.enter_context(clock.patched())
+
+        def make_session(backend=None, lean=None):
+            return HttpSession(server.base_url + '/', OVERVIEW_PATH.lstrip('/'), None, None, cookies={})
+
+        daemon = None
+        if mode == 'daemon':
+            daemon = nba_main.Daemon(make_session().start(), telegram.outbox())
+            stack.callback(daemon.close)
+            poll = daemon.poll
+        else:
+            stack.enter_context(patched(nba_main, make_session=make_session, open_outbox=telegram.outbox))
+            poll = nba_main.scheduled_job
+
+        baseline = None
+        for cycle in range(total_days * cycles_per_day):
+            day = cycle // cycles_per_day
+            if cycle == days * cycles_per_day:
+                tracemalloc.start()
+                baseline = pipeline_traces(tracemalloc.take_snapshot())
+            listed = site.publish(clock.now(pytz.utc))
+            with contextlib.redirect_stdout(sys.stdout if verbose else quiet):
+                started = time.perf_counter()
+                poll()
+                seconds = time.perf_counter() - started
+            samples.append({'cycle': cycle, 'day': day, 'traced': baseline is not None, 'games': listed,
+                            'seconds': round(seconds, 4), **sample(daemon)})
+            clock.advance(step)
+            if (cycle + 1) % cycles_per_day == 0:
+                latest = samples[-1]
+                print(f"Day {day + 1}/{total_days}: {cycle + 1} polls, RSS {latest['rss_mb']} MB, {latest['fds']} fds, "
+                      f"{latest['threads']} threads, {telegram.messages} alerts sent", file=sys.stderr)
+
+        allocators, retained = [], None
+        if baseline is not None:
+            snapshot = pipeline_traces(tracemalloc.take_snapshot())
+            allocators = top_allocators(baseline, snapshot)
+            retained = round(sum(stat.size_diff for stat in snapshot.compare_to(baseline, 'filename')) / 2 ** 20, 2)
+            tracemalloc.stop()
+        alerts = telegram.messages
+
+    checks = check_growth(samples, warmup_days, tolerance, latency_tolerance)
+    return {
+        'parameters': {'mode': mode, 'days': days, 'warmup_days': warmup_days, 'step': step, 'games': games,
+                       'books': books, 'seed': seed, 'move_probability': move_probability},
+        'cycles': len(samples),
+        'alerts_sent': alerts,
+        'checks': checks,
+        'retained_mb': retained,
+        'top_allocators': allocators,
+        'failed': sorted(name for name, check in checks.items() if not check['ok']),
+        'samples': samples,
+    }
+
+
+def print_report(report):
+    print(f"\n{report['cycles']} {report['parameters']['mode']} polls over {report['parameters']['days']} "
+          f"simulated days, {report['alerts_sent']} alerts sent")
+    print(f"{'metric':<18} {'per day (after warmup)':<52} {'limit':>10}")
+    for name, check in report['checks'].items():
+        days = ' '.join(f'{value:g}' for value in check['days'])
+        print(f"{name:<18} {days:<52} {check['limit']:>10g}  {'ok' if check['ok'] else 'GROWING'}")
+    if report['top_allocators']:
+        print(f"\nStill allocated after the traced day: {report['retained_mb']} MB, the largest:")
+        for entry in report['top_allocators']:
+            print(f"{entry['size_diff_kb']:>10.1f} KB {entry['count_diff']:>+8d}  {entry['where']}")
+    if report['failed']:
+        print(f"\nGrowing without a bound: {', '.join(report['failed'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Soak test of the polling pipeline on a simulated clock: memory, '
+                                                 'file descriptors, state files and latency must level off')
+    parser.add_argument('--mode', choices=('daemon', 'cron'), default='daemon',
+                        help='poll with one long-lived Daemon, or call scheduled_job every cycle')
+    parser.add_argument('--days', type=int, default=8, help='simulated days checked for growth')
+    parser.add_argument('--warmup-days', type=int, default=1, help='days left out of the checks')
+    parser.add_argument('--step', type=int, default=600, help='simulated seconds between polls')
+    parser.add_argument('--games', type=int, default=10, help='games per daily slate')
+    parser.add_argument('--books', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--move-probability', type=float, default=0.05, help='chance of every quote moving per poll')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="growth allowed over the earlier days' peak, as a fraction")
+    parser.add_argument('--latency-tolerance', type=float, default=0.5,
+                        help="growth allowed over the earlier days' median poll time, as a fraction")
+    parser.add_argument('--no-trace', action='store_true',
+                        help='skip the extra day under tracemalloc that lists the allocators holding memory')
+    parser.add_argument('--directory', help='keep the state files here instead of a temporary directory')
+    parser.add_argument('--output', help='write the report and every sample as JSON to this file')
+    parser.add_argument('--verbose', action='store_true', help="show the pipeline's own output")
+    args = parser.parse_args()
+    if args.days - args.warmup_days < 2:
+        parser.error('at least two days past the warmup are needed to tell growth from noise')
+
+    report = run(args.mode, args.days, args.warmup_days, args.step, args.games, args.books, args.seed,
+                 args.move_probability, args.directory, args.tolerance, args.latency_tolerance, not args.no_trace,
+                 args.verbose)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    sys.exit(1 if report['failed'] else 0)
@@ -0,0 +1,204 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from nba.nba_helper_functions import RLM_MARKETS, first_per_group, quoted_movements, reported_lines, \
+    reverse_movement_rows
+from nba.nba_history import HISTORY_DIR, read_quotes_file, snapshot_paths
+from nba.nba_notified import to_utc_timestamp
+from nba.nba_parser import MARKETS
+from nba.nba_quotes import QUOTE_KEY, align_quotes, concat_quotes, empty_quotes, update_quotes
+
+BACKTEST_FILE = 'backtest.csv'
+# Default 10 x 10 grid around the live thresholds (money_pc > 0.5, disagreement > 0.4)
+MONEY_THRESHOLDS = np.round(np.arange(0.30, 0.80, 0.05), 2)
+DISAGREEMENT_THRESHOLDS = np.round(np.arange(0.05, 0.55, 0.05), 2)
+
+CANDIDATE_COLUMNS = ['poll', 'codes', 'old', 'new', 'odds', 'money_pc', 'bets_pc', 'game_id', 'team', 'book']
+
+
+def poll_paths(market, root=HISTORY_DIR, start=None, end=None):
+    # Snapshot files of a market oldest first, date partitions outside [start, end] are skipped by name
+    start_date = f'date={to_utc_timestamp(start):%Y-%m-%d}' if start is not None else None
+    end_date = f'date={to_utc_timestamp(end):%Y-%m-%d}' if end is not None else None
+    paths = []
+    for path in snapshot_paths(market, root):
+        date_dir = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        if (start_date and date_dir < start_date) or (end_date and date_dir > end_date):
+            continue
+        paths.append(path)
+    return paths[::-1]
+
+
+def take(movements, rows, poll, offset):
+    return {'poll': np.full(len(rows), poll), 'codes': movements['codes'][rows] + offset,
+            **{column: movements[column][rows] for column in CANDIDATE_COLUMNS[2:]}}
+
+
+def replay_market(market, root=HISTORY_DIR, start=None, end=None):
+    # Streams every stored poll of a market in scrape order through the alignment and the threshold independent
+    # half of the detection. Only what a threshold can turn into an alert is kept:
+    #   moved - quotes whose line (or price) changed, the only ones a reverse line movement can pick (RLM_MARKETS)
+    #   first - the first quoted book of every team in every poll, the one a disagreement alert reports
+    # plus the closing quotes, the last ones stored before each game's tipoff.
+    state = empty_quotes()
+    closed = []
+    moved, first = [], []
+    offset = 0
+    polls = 0
+    for poll, path in enumerate(poll_paths(market, root, start, end)):
+        quotes = read_quotes_file(path, market)
+        if quotes.empty:
+            continue
+        polls += 1
+        scrape_ts = quotes['scrape_ts'].iloc[0]
+        # Games that started since the previous poll are closed, their last quotes are the closing line
+        started = (state['time'] <= scrape_ts).to_numpy()
+        if started.any():
+            closed.append(state[started])
+            state = state[~started]
+        quotes = quotes[quotes['time'] > scrape_ts]
+
+        movements = quoted_movements(align_quotes(state, quotes), market)
+        if movements is not None:
+            codes = movements['codes']
+            if market in RLM_MARKETS:
+                moved.append(take(movements, np.flatnonzero(movements['new'] != movements['old']), poll, offset))
+            first.append(take(movements, first_per_group(codes, np.arange(len(codes)))[1], poll, offset))
+            # Group numbers stay unique over the whole replay
+            offset += codes.max() + 1
+        state = update_quotes(state, quotes)
+    closed.append(state)
+
+    closing = concat_quotes(closed).drop_duplicates(QUOTE_KEY, keep='last')
+    closing = closing.astype({column: object for column in QUOTE_KEY}).set_index(QUOTE_KEY)[['line', 'odds']]
+    return {'market': market, 'polls': polls, 'moved': concat_candidates(moved), 'first': concat_candidates(first),
+            'closing': closing.rename(columns={'line': 'close_line', 'odds': 'close_odds'}).astype(float)}
+
+
+def concat_candidates(parts):
+    if not parts:
+        return {column: np.array([]) for column in CANDIDATE_COLUMNS}
+    return {column: np.concatenate([part[column] for part in parts]) for column in CANDIDATE_COLUMNS}
+
+
+def select(candidates, rows, kind, market):
+    return pd.DataFrame({
+        'kind': kind,
+        'poll': candidates['poll'][rows],
+        'game_id': candidates['game_id'][rows],
+        'team': candidates['team'][rows],
+        'book': candidates['book'][rows],
+        'line': reported_lines(candidates['new'][rows], market),
+        'odds': candidates['odds'][rows],
+    })
+
+
+def evaluate(replay, money_threshold, disagreement_threshold):
+    # Alerts one configuration would have sent over the replay, deduplicated per game like the notified store,
+    # and how their price compares with the closing quote of the same book
+    market = replay['market']
+    moved, first = replay['moved'], replay['first']
+    rlm_rows = reverse_movement_rows(moved['codes'].astype(np.int64), moved['old'], moved['new'], moved['odds'],
+                                     moved['money_pc'], market, money_threshold)
+    with np.errstate(invalid='ignore'):
+        disagreement_rows = np.flatnonzero(first['money_pc'] - first['bets_pc'] > disagreement_threshold)
+    alerts = pd.concat([select(moved, rlm_rows, 'rlm', market),
+                        select(first, disagreement_rows, 'disagreement', market)], ignore_index=True)
+    alerts = alerts.sort_values('poll', kind='stable').drop_duplicates(['kind', 'game_id', 'team', 'line', 'book'])
+
+    alerts = alerts.join(replay['closing'], on=QUOTE_KEY)
+    # Closing line value in implied probability: positive when the price shortened after the alert
+    alerts['clv'] = 1 / alerts['close_odds'] - 1 / alerts['odds']
+    # and in points for spreads, taking the alerted team's side
+    alerts['clv_points'] = alerts['line'] - alerts['close_line'] if market == 'spread' else np.nan
+
+    result = {'market': market, 'money_threshold': money_threshold, 'disagreement_threshold': disagreement_threshold}
+    for kind in ('rlm', 'disagreement'):
+        if kind == 'rlm' and market not in RLM_MARKETS:
+            # Left empty, not zero: no threshold could have made these alerts
+            result.update({f'rlm_{column}': np.nan for column in ('alerts', 'games', 'clv_mean', 'beat_close',
+                                                                  'clv_points')})
+            continue
+        kind_alerts = alerts[alerts['kind'] == kind]
+        clv = kind_alerts['clv'].dropna()
+        result.update({
+            f'{kind}_alerts': len(kind_alerts),
+            f'{kind}_games': kind_alerts['game_id'].nunique(),
+            f'{kind}_clv_mean': round(clv.mean(), 5) if len(clv) else np.nan,
+            f'{kind}_beat_close': round((clv > 0).mean(), 4) if len(clv) else np.nan,
+            f'{kind}_clv_points': round(kind_alerts['clv_points'].mean(), 3) if market == 'spread' and len(clv)
+            else np.nan,
+        })
+    return result
+
+
+# Replays shared with the pool's worker processes once, not pickled with every configuration
+worker_replays = {}
+
+
+def init_worker(replays):
+    worker_replays.update(replays)
+
+
+def evaluate_config(config):
+    market, money_threshold, disagreement_threshold = config
+    return evaluate(worker_replays[market], money_threshold, disagreement_threshold)
+
+
+def replay_task(args):
+    return replay_market(*args)
+
+
+def backtest(markets=tuple(MARKETS), money_thresholds=MONEY_THRESHOLDS,
+             disagreement_thresholds=DISAGREEMENT_THRESHOLDS, root=HISTORY_DIR, start=None, end=None, workers=None):
+    workers = workers or os.cpu_count()
+    started = time.perf_counter()
+    # One replay per market, in parallel; each one is sequential as every poll is compared with the one before
+    with ProcessPoolExecutor(max_workers=min(workers, len(markets))) as pool:
+        replays = {replay['market']: replay
+                   for replay in pool.map(replay_task, [(market, root, start, end) for market in markets])}
+    replayed = time.perf_counter()
+
+    configs = [(market, float(money), float(disagreement)) for market in markets
+               for money in money_thresholds for disagreement in disagreement_thresholds]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(replays,)) as pool:
+        results = list(pool.map(evaluate_config, configs, chunksize=max(1, len(configs) // (workers * 4))))
+
+    polls = ', '.join(f"{market} {replay['polls']} polls" for market, replay in replays.items())
+    print(f"Replayed {polls} in {replayed - started:.1f}s, evaluated {len(configs)} configurations in "
+          f"{time.perf_counter() - replayed:.1f}s with {workers} workers")
+    skipped = [market for market in markets if market not in RLM_MARKETS]
+    if skipped:
+        print(f"Reverse line movement is not detected on {', '.join(skipped)}, their rlm columns are left empty")
+    return pd.DataFrame(results)
+
+
+def parse_range(value):
+    # 'start:stop:step' (stop excluded) or a comma separated list
+    if ':' in value:
+        start, stop, step = (float(part) for part in value.split(':'))
+        return np.round(np.arange(start, stop, step), 4)
+    return [float(part) for part in value.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay the odds history through the detection over a threshold grid')
+    parser.add_argument('--markets', default=','.join(MARKETS))
+    parser.add_argument('--money', type=parse_range, default=MONEY_THRESHOLDS,
+                        help="money percentage thresholds, 'start:stop:step' or a list")
+    parser.add_argument('--disagreement', type=parse_range, default=DISAGREEMENT_THRESHOLDS,
+                        help="money minus bets thresholds, 'start:stop:step' or a list")
+    parser.add_argument('--root', default=HISTORY_DIR)
+    parser.add_argument('--start', help='first scrape date, e.g. 2024-10-22')
+    parser.add_argument('--end', help='last scrape date')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default=BACKTEST_FILE)
+    args = parser.parse_args()
+
+    report = backtest(args.markets.split(','), args.money, args.disagreement, args.root, args.start, args.end,
+                      args.workers)
+    report.to_csv(args.output, index=False)
+    print(f"Wrote {len(report)} configurations to {args.output}")
@@ -0,0 +1,177 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+from selenium.common.exceptions import WebDriverException
+from nba.nba_metrics import METRICS
+
+DRIVER_CACHE_FILE = os.environ.get('NBA_DRIVER_CACHE', 'chromedriver_cache.json')
+# Explicit chromedriver binary, skips the resolution entirely
+DRIVER_PATH = os.environ.get('NBA_CHROMEDRIVER')
+# Pin a chromedriver version (e.g. 120.0.6099.109), by default the one webdriver_manager picks for Chromium
+PINNED_VERSION = os.environ.get('NBA_CHROMEDRIVER_VERSION') or None
+# A cached driver is resolved again after this long, Chromium updates would otherwise never be picked up
+CACHE_MAX_AGE = int(os.environ.get('NBA_DRIVER_CACHE_DAYS', '7')) * 24 * 3600
+
+# Lean profile: only the DOM text and alt attributes are parsed, images, fonts, ads and analytics are dropped
+LEAN_BLOCKED_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif', 'webp', 'avif', 'svg', 'ico', 'woff', 'woff2', 'ttf', 'otf',
+                           'mp4', 'webm']
+LEAN_BLOCKED_DOMAINS = ['googletagmanager.com', 'google-analytics.com', 'doubleclick.net', 'googlesyndication.com',
+                        'adservice.google.com', 'amazon-adsystem.com', 'facebook.net', 'scorecardresearch.com',
+                        'hotjar.com', 'taboola.com', 'outbrain.com', 'quantserve.com', 'adnxs.com', 'criteo.com']
+LEAN_BLOCKED_URLS = [pattern for extension in LEAN_BLOCKED_EXTENSIONS
+                     for pattern in (f'*.{extension}', f'*.{extension}?*')] + \
+                    [f'*{domain}*' for domain in LEAN_BLOCKED_DOMAINS]
+
+# The performance log costs Chrome a buffer of every network event; on for the lean profile, which is measured
+# against the full one, or when NBA_MEASURE_TRAFFIC=1
+MEASURE_TRAFFIC = os.environ.get('NBA_MEASURE_TRAFFIC') == '1'
+
+# Resolved once per process, every driver of the pool uses the same binary
+resolved = {}
+
+
+def is_executable(path):
+    return bool(path) and os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def driver_version(path):
+    try:
+        output = subprocess.run([path, '--version'], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = re.search(r'\d+(?:\.\d+)+', output)
+    return match.group(0) if match else None
+
+
+def load_cached_driver(cache_file=DRIVER_CACHE_FILE, version=PINNED_VERSION, max_age=CACHE_MAX_AGE):
+    try:
+        with open(cache_file) as file:
+            entry = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if not is_executable(entry.get('path')):
+        return None
+    if version and entry.get('version') != version:
+        return None
+    if time.time() - entry.get('resolved_at', 0) > max_age:
+        return None
+    return entry['path']
+
+
+def save_cached_driver(path, source, cache_file=DRIVER_CACHE_FILE):
+    entry = {'path': path, 'version': driver_version(path), 'source': source, 'resolved_at': time.time()}
+    temp_file = f'{cache_file}.tmp'
+    with open(temp_file, 'w') as file:
+        json.dump(entry, file)
+    os.replace(temp_file, cache_file)
+
+
+def download_driver(version=PINNED_VERSION):
+    # Imported here, webdriver_manager (and its network round trip) is only needed when nothing is cached
+    from webdriver_manager.chrome import ChromeDriverManager
+    from webdriver_manager.core.os_manager import ChromeType
+    return ChromeDriverManager(driver_version=version, chrome_type=ChromeType.CHROMIUM).install()
+
+
+def resolve_chromedriver(refresh=False, cache_file=DRIVER_CACHE_FILE):
+    # Explicit path, then this process, the disk cache, a webdriver_manager download and finally
+    # whatever chromedriver is on the PATH (e.g. offline). Returns the path and where it came from.
+    if DRIVER_PATH:
+        return DRIVER_PATH, 'NBA_CHROMEDRIVER'
+    if not refresh and 'path' in resolved:
+        return resolved['path'], resolved['source']
+
+    path, source = (None, None) if refresh else (load_cached_driver(cache_file), 'cache')
+    if path is None:
+        try:
+            path, source = download_driver(), 'webdriver_manager'
+        except Exception as e:
+            print(f"Could not resolve chromedriver with webdriver_manager ({e}), looking for a system chromedriver")
+            path, source = shutil.which('chromedriver'), 'system'
+        if path is None:
+            raise RuntimeError("No chromedriver found, set NBA_CHROMEDRIVER to its path")
+        save_cached_driver(path, source, cache_file)
+
+    resolved.update(path=path, source=source)
+    return path, source
+
+
+def build_chrome_options(lean=False, measure=MEASURE_TRAFFIC):
+    # Imported here, selenium.webdriver is only needed when a browser is started
+    from selenium.webdriver.chrome.options import Options
+    chrome_options = Options()
+    options = ["--disable-dev-shm-usage", "--headless", "--window-size=1920,1200"]
+    if lean:
+        options.append("--blink-settings=imagesEnabled=false")
+        # get() returns at DOMContentLoaded instead of waiting for every image, ad and tracker
+        chrome_options.page_load_strategy = 'eager'
+        chrome_options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+    for option in options:
+        chrome_options.add_argument(option)
+    if lean or measure:
+        # Network events of the performance log give the bytes transferred per page
+        chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+    return chrome_options
+
+
+def start_chrome(driver_path, lean=False):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+    with METRICS.timed('browser_start'):
+        driver = webdriver.Chrome(service=Service(driver_path), options=build_chrome_options(lean))
+    driver.logs_traffic = lean or MEASURE_TRAFFIC
+    if lean:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': LEAN_BLOCKED_URLS})
+    return driver
+
+
+def process_tree_rss(pid):
+    # Resident memory of a process and all its descendants (chromedriver, Chrome and its renderers), from /proc.
+    # None where /proc is not available.
+    if pid is None or not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as file:
+                # The command name may contain spaces, the parent pid is the second field after it
+                parent = int(file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/statm') as file:
+                total += int(file.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+        pending.extend(children.get(current, []))
+    return total
+
+
+def drain_transferred_bytes(driver):
+    # Bytes received since the last call, summed over the Network.loadingFinished events of the performance log.
+    # None when the driver was started without the log.
+    if not getattr(driver, 'logs_traffic', False):
+        return None
+    try:
+        entries = driver.get_log('performance')
+    except WebDriverException:
+        return None
+    transferred = 0
+    for entry in entries:
+        if '"Network.loadingFinished"' not in entry['message']:
+            continue
+        transferred += json.loads(entry['message'])['message']['params'].get('encodedDataLength', 0)
+    return int(transferred)
@@ -0,0 +1,41 @@
+from selenium.common.exceptions import NoSuchElementException
+from nba.nba_helper_functions import GAME_PAGE_SELECTORS, load_page, wait_for_page, open_money_view
+from nba.nba_moneyline import open_moneyline_tab
+from nba.nba_parser import make_soup, parse_game_time, parse_game_snapshots
+from nba.nba_points import open_total_tab
+from nba.nba_readiness import PageWaits
+
+
+def capture_game_snapshots(driver, url):
+    # Load the matchup page once and take one page source snapshot per tab state
+    waits = PageWaits(driver, url, timeout=60)
+    load_page(driver, url)
+    wait_for_page(waits, GAME_PAGE_SELECTORS)
+
+    # The spread tab and the bets trends are the ones shown on page load
+    bets_soup = make_soup(driver.page_source)
+    if parse_game_time(bets_soup) is None:
+        return None  # Gracefully exit the function if the game is over
+    snapshots = {'bets': bets_soup}
+
+    # Bets/money percentages of all three markets live in the same trends tables
+    if open_money_view(driver, waits):
+        snapshots['money'] = driver.page_source
+
+    open_total_tab(driver)
+    snapshots['total'] = driver.page_source
+
+    try:
+        open_moneyline_tab(driver)
+        snapshots['moneyline'] = driver.page_source
+    except NoSuchElementException:
+        print(f"Moneyline tab not found for {url}, skipping moneyline...")
+
+    return snapshots
+
+
+def extract_game_data(driver, url):
+    snapshots = capture_game_snapshots(driver, url)
+    if snapshots is None:
+        return None
+    return parse_game_snapshots(snapshots)
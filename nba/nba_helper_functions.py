@@ -1,16 +1,92 @@
 import re
 from datetime import datetime
+import numpy as np
 import pandas as pd
 import pytz
-from selenium import webdriver
-from webdriver_manager.chrome import ChromeDriverManager
-from webdriver_manager.core.os_manager import ChromeType
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
+from selenium.common.exceptions import ElementClickInterceptedException, SessionNotCreatedException
+from nba.nba_driver import drain_transferred_bytes, resolve_chromedriver, start_chrome
+from nba.nba_metrics import METRICS
+from nba.nba_notified import NotifiedStore, NOTIFIED_MOVEMENTS_FILE
+from nba.nba_quotes import REFERENCE_BOOKS, game_key
 
+MONEY_PC_BUTTON_SELECTOR = "#trends-component > div > ul > li:nth-child(2) > span"
+# Elements a game page or the odds overview is parsed from, what readiness waits target
+GAME_PAGE_SELECTORS = ("#odds-table-spread--0", "#trends-table-bets--0")
+OVERVIEW_SELECTORS = ("#odds-table-spread--0",)
+# Markets reverse line movement is detected on. The original spread and total rule also required a book whose line
+# both moved and stayed unchanged, which never holds, so it never fired there and that branch is gone.
+RLM_MARKETS = ('moneyline',)
 
-def page_has_loaded(driver):
-    return driver.execute_script("return document.readyState") == "complete"
+
+def load_page(driver, url):
+    # Traffic of clicks and late requests on the previous page is counted, but not charged to this one
+    previous_bytes = drain_transferred_bytes(driver)
+    with METRICS.timed('page_load', url=url) as fields:
+        driver.get(url)
+        transferred = drain_transferred_bytes(driver)
+        if transferred is not None:
+            fields['bytes'] = transferred
+            METRICS.increment('page_bytes', transferred + (previous_bytes or 0))
+
+
+def wait_for_page(waits, selectors=()):
+    # The tables a page is parsed from, or the fully loaded document for pages without them
+    return waits.ready(selectors)
+
+
+def click_with_retry(element):
+    # Overlays (cookie banner, ads) can intercept the click while the page settles, a script click goes through
+    # them instead of sleeping until they are gone
+    try:
+        element.click()
+    except ElementClickInterceptedException:
+        METRICS.increment('intercepted_clicks')
+        element.parent.execute_script("arguments[0].click();", element)
+    return True
+
+
+def open_money_view(driver, waits):
+    # Switch the trends tables to the money percentage view, returns False if it never shows up
+    # Imported here, selenium.webdriver is only needed by the browser backend
+    from selenium.webdriver.common.by import By
+    money_pc_button = driver.find_element(By.CSS_SELECTOR, MONEY_PC_BUTTON_SELECTOR)
+    click_with_retry(money_pc_button)
+    money_pc_selector = "#trends-table-money--0 > tr:nth-child(2) > td:nth-child(2)"
+    if waits.present(money_pc_selector):
+        return True
+    print("No money percentage table available.")
+    return False
+
+
+def parse_american_odds(value):
+    return american_to_decimal(float(value.replace('even', '-100')))
+
+
+def parse_total_points(point):
+    return float(point.replace('o', '+').replace('u', '-'))
+
+
+def build_market_records(game_time, rows, trends, line_column, bookmakers=()):
+    # Every header bookmaker gets its columns, empty when unquoted, so the snapshot keeps the page's book order
+    # even when the first game lacks a book; the first quoted book of a team is picked in that order
+    game_data = []
+    game_id = game_key(game_time, [team for team, _ in rows])
+    for (team, quotes), pcs in zip(rows, trends):
+        team_data = {
+            'game_id': game_id,
+            'time': game_time,
+            'team': team,
+            'bets_pc': pcs.get('bets_pc'),
+            'money_pc': pcs.get('money_pc')
+        }
+        # Add lines and odds for each bookmaker
+        for bookmaker in dict.fromkeys([*bookmakers, *quotes]):
+            line, odds = quotes.get(bookmaker, (None, None))
+            if line_column:
+                team_data[f'{bookmaker}_{line_column}'] = line
+            team_data[f'{bookmaker}_odds'] = odds
+        game_data.append(team_data)
+    return game_data
 
 
 def convert_percentage_to_decimal(percentage_string):
@@ -40,118 +116,174 @@ def decimal_to_american(decimal_odds):
         return -100 / (decimal_odds - 1)
 
 
-def detect_reverse_line_movements(merged_df, bet_type, bookmakers):
-    # Initialize a list to store profitable opportunities
+def first_per_group(codes, rows):
+    # First of the given row positions in each group, rows are in frame order
+    groups, first = np.unique(codes[rows], return_index=True)
+    return groups, rows[first]
+
+
+def page_percentages(column):
+    # Trends are whole percentages on the page; rounding the float32 quote column back to them keeps the
+    # threshold comparisons exact (0.3 in float32 is above 0.3)
+    return np.round(column.to_numpy(dtype=float, na_value=np.nan), 2)
+
+
+def quoted_movements(aligned, bet_type):
+    # Threshold independent half of the detection: the non-reference quotes present in both polls, as arrays,
+    # with one group per game and team numbered in frame order. None if nothing is quoted twice.
+    # Spread and total lines move; moneyline has no line and its decimal price is what moves.
+    if aligned.empty:
+        return None
+    value = 'odds' if bet_type == 'moneyline' else 'line'
+    old_values = aligned[f'{value}_old'].to_numpy(dtype=float, na_value=np.nan)
+    new_values = aligned[f'{value}_new'].to_numpy(dtype=float, na_value=np.nan)
+    books = aligned['book'].to_numpy()
+    reference = np.isin(books, REFERENCE_BOOKS)
+    # A bookmaker only counts if both its old and new quotes exist
+    rows = np.flatnonzero(~reference & ~np.isnan(old_values) & ~np.isnan(new_values))
+    if not len(rows):
+        return None
+
+    game_ids = aligned['game_id'].to_numpy()
+    teams = aligned['team'].to_numpy()
+    is_open = books == 'Open'
+    codes = pd.factorize(aligned['game_id'].cat.codes.to_numpy()[rows].astype(np.int64) *
+                         len(aligned['team'].cat.categories) + aligned['team'].cat.codes.to_numpy()[rows])[0]
+    return {
+        'codes': codes,
+        'old': old_values[rows],
+        'new': new_values[rows],
+        'odds': aligned['odds_new'].to_numpy(dtype=float, na_value=np.nan)[rows],
+        'money_pc': page_percentages(aligned['money_pc'])[rows],
+        'bets_pc': page_percentages(aligned['bets_pc'])[rows],
+        'game_id': game_ids[rows],
+        'team': teams[rows],
+        'book': books[rows],
+        'time': aligned['time'].iloc[rows],
+        'opening': dict(zip(zip(game_ids[is_open], teams[is_open]), new_values[is_open])),
+    }
+
+
+def reverse_movement_rows(codes, old_values, new_values, new_odds, money_pc, bet_type, money_threshold=0.5):
+    # Reverse line movement: the price moved against the side the money is on, see RLM_MARKETS.
+    # Returns, per group that qualifies, the row with the best odds among the books that moved.
+    if not len(codes) or bet_type not in RLM_MARKETS:
+        return np.array([], dtype=np.int64)
+    with np.errstate(invalid='ignore'):
+        rlm = ((money_pc > money_threshold) & (new_values > old_values)) | \
+              ((money_pc < money_threshold) & (new_values < old_values))
+
+    # The first book wins ties
+    rlm_rows = np.flatnonzero(rlm)
+    order = rlm_rows[np.lexsort((rlm_rows, -new_odds[rlm_rows], codes[rlm_rows]))]
+    return first_per_group(codes, order)[1]
+
+
+def reported_lines(new_values, bet_type):
+    # Moneyline alerts report the American price in place of the missing line
+    if bet_type != 'moneyline':
+        return new_values
+    with np.errstate(divide='ignore'):
+        return np.round(np.where(new_values >= 2.0, (new_values - 1) * 100, -100 / (new_values - 1)))
+
+
+def detect_reverse_line_movements(aligned, bet_type, money_threshold=0.5, disagreement_threshold=0.4):
+    # aligned holds one row per game, team and book with its previous and new quote (see align_quotes)
     rlm_opportunities = []
     disagreement_opportunities = []
-    # Detect reverse line movements and identify bookmakers that haven't moved their line or offer the best value
-    for index, row in merged_df.iterrows():
-        if row['money_pc_new'] is None:
-            continue
-
-        unchanged_bookmakers = []
-        best_value = None
-        best_value_bookmaker = None
-        best_value_line = None
-        best_disagreement_value = None
-        best_disagreement_bookmaker = None
-        best_disagreement_odds = None
-        best_disagreement_line = None
-
-        # Convert American odds to Decimal odds for comparison
-        for bookmaker in bookmakers:
-            # Check if both old and new lines exist, otherwise continue to the next bookmaker
-            old_line_key = f'{bookmaker}_{bet_type}_old'
-            new_line_key = f'{bookmaker}_{bet_type}_new'
-            if old_line_key not in row or new_line_key not in row or pd.isnull(row[old_line_key]) or pd.isnull(row[new_line_key]):
-                continue
-
-            old_line = row[old_line_key]
-            new_line = row[new_line_key]
-            money_pc = row['money_pc_new']
-            bets_pc = row['bets_pc_new']
-            new_odds = row[f'{bookmaker}_odds_new']
-            opening_odds = row[f'Open_{bet_type}_new']
-            disagreement = money_pc - bets_pc
-
-            # Check for reverse line movement condition
-            if (money_pc > 0.5 and new_line > old_line) or (money_pc < 0.5 and new_line < old_line):
-                if old_line == new_line:
-                    unchanged_bookmakers.append(bookmaker)
-                if best_value is None or new_odds > best_value:
-                    best_value = new_odds
-                    best_value_bookmaker = bookmaker
-                    best_value_line = new_line
-
-            # Handle disagreements
-            if disagreement > 0.4:  # Example threshold
-                if best_disagreement_value is None or (new_odds > best_disagreement_odds
-                                                       and disagreement > best_disagreement_value
-                                                       and (abs(new_odds - opening_odds) <= 1)):
-                    best_disagreement_value = disagreement
-                    best_disagreement_bookmaker = bookmaker
-                    best_disagreement_odds = new_odds
-                    best_disagreement_line = new_line
-
-            # After processing all bookmakers, append the best disagreement opportunity
-            if best_disagreement_value:
-                disagreement_opportunities.append({
-                    'time': row['time_new'],
-                    'team': row['team'],
-                    'line': best_disagreement_line,
-                    'bookmaker': best_disagreement_bookmaker,
-                    'odds': round(best_disagreement_odds, 2),
-                    'money_pc': money_pc * 100,
-                    'bets_pc': bets_pc * 100,
-                    'disagreement': round((best_disagreement_value * 100), 2),
-                    'bet_type': bet_type,
-                    'open': opening_odds
-                })
-
-            # Add RLM opportunities as before
-            if unchanged_bookmakers and best_value_bookmaker:
-                rlm_opportunities.append({
-                    'time_new': row['time_new'],
-                    'team': row['team'],
-                    'best_value_bookmaker': best_value_bookmaker,
-                    'best_value_odds': best_value,
-                    'line': best_value_line,
-                    'bet_type': bet_type,
-                })
+    movements = quoted_movements(aligned, bet_type)
+    if movements is None:
+        return rlm_opportunities, disagreement_opportunities
+
+    codes = movements['codes']
+    new_odds = movements['odds']
+    money_pc = movements['money_pc']
+    bets_pc = movements['bets_pc']
+    disagreement = money_pc - bets_pc
+    lines = reported_lines(movements['new'], bet_type)
+    best_rows = reverse_movement_rows(codes, movements['old'], movements['new'], new_odds, money_pc, bet_type,
+                                      money_threshold)
+
+    # Disagreement between money and bets keeps the first quoted bookmaker of the team
+    _, first_rows = first_per_group(codes, np.arange(len(codes)))
+    with np.errstate(invalid='ignore'):
+        disagreement_rows = first_rows[disagreement[first_rows] > disagreement_threshold]
+
+    times = movements['time']
+    game_ids = movements['game_id']
+    teams = movements['team']
+    books = movements['book']
+    for i in disagreement_rows:
+        disagreement_opportunities.append({
+            'time': times.iloc[i],
+            'game_id': game_ids[i],
+            'team': teams[i],
+            'line': round(lines[i]) if bet_type == 'moneyline' else float(lines[i]),
+            'bookmaker': books[i],
+            'odds': round(float(new_odds[i]), 2),
+            'money_pc': round(money_pc[i] * 100, 2),
+            'bets_pc': round(bets_pc[i] * 100, 2),
+            'disagreement': round((disagreement[i] * 100), 2),
+            'bet_type': bet_type,
+            'open': float(movements['opening'].get((game_ids[i], teams[i]), np.nan))
+        })
+
+    for i in best_rows:
+        rlm_opportunities.append({
+            'time_new': times.iloc[i],
+            'game_id': game_ids[i],
+            'team': teams[i],
+            'best_value_bookmaker': books[i],
+            'best_value_odds': round(float(new_odds[i]), 2),
+            'line': round(lines[i]) if bet_type == 'moneyline' else float(lines[i]),
+            'bet_type': bet_type,
+        })
 
     return rlm_opportunities, disagreement_opportunities
 
 
-def detect_and_accumulate(df, bet_type, bookmakers):
-    rlm_opportunities, disagreement_opportunities = detect_reverse_line_movements(df, bet_type, bookmakers)
-    NOTIFIED_MOVEMENTS_FILE = 'notified_movements.csv'
+def best_price_line(prices, opportunity, bookmaker):
+    # Where the alerted side is best priced across all books, when that is not the alerted bookmaker
+    if prices is None:
+        return ''
+    line = None if opportunity['bet_type'] == 'moneyline' else opportunity['line']
+    best = prices.best(opportunity['game_id'], opportunity['bet_type'], opportunity['team'], line)
+    if best is None or best[1] == bookmaker:
+        return ''
+    odds, book, best_line = best
+    return (f"- <b>Best price</b>: {round(odds, 2)} with {book}"
+            + (f", line: {best_line}" if line is not None else '') + "\n")
 
-    try:
-        notified_movements = pd.read_csv(NOTIFIED_MOVEMENTS_FILE)
-        notified_movements = remove_past_events(notified_movements)
-    except FileNotFoundError:
-        notified_movements = pd.DataFrame(columns=['identifier', 'time'])
+
+def detect_and_accumulate(aligned, bet_type, notified_movements=None, prices=None):
+    # prices, a BestPriceIndex holding the new quotes, adds the best price on the market to every alert
+    rlm_opportunities, disagreement_opportunities = detect_reverse_line_movements(aligned, bet_type)
+
+    # Passes in the same run share one store, a standalone call loads and flushes its own
+    owns_store = notified_movements is None
+    if owns_store:
+        notified_movements = NotifiedStore.load(NOTIFIED_MOVEMENTS_FILE)
 
     all_messages = []
     for opportunity in rlm_opportunities:
-        identifier = f"{opportunity['team']}_{opportunity['bet_type']}_{opportunity['line']}_{opportunity['best_value_bookmaker']}_rlm"
-        time = opportunity['time_new']
-        new_row = {'identifier': identifier, 'time': time}
-
-        if identifier not in notified_movements['identifier'].values:
+        # The game id keeps a team's next game (e.g. a back-to-back) from matching this alert
+        identifier = (f"{opportunity['game_id']}_{opportunity['team']}_{opportunity['bet_type']}_{opportunity['line']}_"
+                      f"{opportunity['best_value_bookmaker']}_rlm")
+        if identifier not in notified_movements:
             subject = f"<b>Reverse Line Movement Detected for {opportunity['team']}</b>"
-            message = f"""{subject}<br>
-                    - Best value is with <b>{opportunity['best_value_bookmaker']}</b> offering odds <b>{opportunity['best_value_odds']}</b> on <b>{opportunity['bet_type']}</b> , line: <b>{opportunity['line']}</b>."""
+            # Telegram's HTML parse mode has no <br>, lines are separated by newlines as in the other alerts
+            message = (f"{subject}\n"
+                       f"- Best value is with <b>{opportunity['best_value_bookmaker']}</b> offering odds "
+                       f"<b>{opportunity['best_value_odds']}</b> on <b>{opportunity['bet_type']}</b>, "
+                       f"line: <b>{opportunity['line']}</b>.\n"
+                       f"{best_price_line(prices, opportunity, opportunity['best_value_bookmaker'])}")
             all_messages.append(message)
-            new_row_df = pd.DataFrame([new_row])  # Convert the new row to a single-row DataFrame
-            notified_movements = pd.concat([notified_movements, new_row_df], ignore_index=True)
+            notified_movements.add(identifier, opportunity['time_new'])
 
     for opportunity in disagreement_opportunities:
-        identifier = f"{opportunity['team']}_{opportunity['bet_type']}_{opportunity['line']}_{opportunity['bookmaker']}_dg"
-        time = opportunity['time']
-        new_row = {'identifier': identifier, 'time': time}
-
-        if identifier not in notified_movements['identifier'].values:
+        identifier = (f"{opportunity['game_id']}_{opportunity['team']}_{opportunity['bet_type']}_{opportunity['line']}_"
+                      f"{opportunity['bookmaker']}_dg")
+        if identifier not in notified_movements:
             decision = "on" if opportunity['money_pc'] > 50 else "against"
             bet_message = f'Bet {decision} {opportunity["team"]} on {opportunity["bet_type"]}, line: {opportunity["line"]}'
             bet_line = opportunity["line"]
@@ -167,25 +299,30 @@ def detect_and_accumulate(df, bet_type, bookmakers):
                        f"- <b>Line</b>: {bet_line}\n"
                        f"- <b>Money Percentage</b>: {money_pc}%\n"
                        f"- <b>Betting Percentage</b>: {bets_pc}%\n"
-                       f"- <b>Disagreement</b>: {disagreement}%\n")
+                       f"- <b>Disagreement</b>: {disagreement}%\n"
+                       f"{best_price_line(prices, opportunity, bookmaker)}")
             all_messages.append(message)
-            new_row_df = pd.DataFrame([new_row])  # Convert the new row to a single-row DataFrame
-            notified_movements = pd.concat([notified_movements, new_row_df], ignore_index=True)
+            notified_movements.add(identifier, opportunity['time'])
 
-    # Save the updated DataFrame to CSV
-    notified_movements.to_csv(NOTIFIED_MOVEMENTS_FILE, index=False)
+    # Write the batch once
+    if owns_store:
+        notified_movements.flush()
 
     return "\n\n".join(all_messages)
 
 
-def initialize_webdriver():
+def initialize_webdriver(lean=False):
     try:
-        chrome_service = Service(ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install())
-        chrome_options = Options()
-        options = ["--disable-dev-shm-usage", "--headless", "--window-size=1920,1200"]
-        for option in options:
-            chrome_options.add_argument(option)
-        driver = webdriver.Chrome(service=chrome_service, options=chrome_options)
+        with METRICS.timed('driver_resolve'):
+            driver_path, source = resolve_chromedriver()
+        try:
+            driver = start_chrome(driver_path, lean)
+        except SessionNotCreatedException as e:
+            # A cached chromedriver no longer matches the installed Chromium, resolve it again once
+            print(f"Chromedriver from {source} was rejected ({e.msg}), resolving it again...")
+            with METRICS.timed('driver_resolve'):
+                driver_path, source = resolve_chromedriver(refresh=True)
+            driver = start_chrome(driver_path, lean)
     except Exception as e:
         print(f"An error occurred while initializing the webdriver: {e}")
         driver = None
@@ -0,0 +1,177 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytz
+from nba.nba_metrics import METRICS
+from nba.nba_notified import to_utc_timestamp
+from nba.nba_quotes import as_quote_dtypes, concat_quotes, empty_quotes
+
+HISTORY_DIR = 'nba_history'
+
+# One row per scrape, game, team and bookmaker; the market is the partition
+HISTORY_SCHEMA = pa.schema([
+    ('game_id', pa.string()),
+    ('scrape_ts', pa.timestamp('us', tz='UTC')),
+    ('time', pa.timestamp('us', tz='UTC')),
+    ('team', pa.string()),
+    ('book', pa.string()),
+    ('line', pa.float32()),
+    ('odds', pa.float32()),
+    ('bets_pc', pa.float32()),
+    ('money_pc', pa.float32()),
+])
+PARTITIONING = ds.partitioning(pa.schema([('date', pa.string()), ('market', pa.string())]), flavor='hive')
+
+
+def partition_path(root, market, scrape_ts):
+    return os.path.join(root, f'date={scrape_ts:%Y-%m-%d}', f'market={market}')
+
+
+def append_quotes(quotes, market, scrape_ts=None, root=HISTORY_DIR):
+    # Append-only: every scrape gets its own file in the date/market partition
+    if quotes is None or quotes.empty:
+        return None
+    scrape_ts = to_utc_timestamp(scrape_ts or datetime.now(pytz.utc))
+    directory = partition_path(root, market, scrape_ts)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'part-{scrape_ts:%Y%m%dT%H%M%S%fZ}.parquet')
+    quotes = quotes.assign(scrape_ts=scrape_ts).astype({'game_id': str, 'team': str, 'book': str})
+    table = pa.Table.from_pandas(quotes[HISTORY_SCHEMA.names], schema=HISTORY_SCHEMA, preserve_index=False)
+    pq.write_table(table, path)
+    return path
+
+
+class HistoryWriter:
+    # Appends polls on a background thread, in submission order, so alerts never wait for a parquet write
+
+    def __init__(self, root=HISTORY_DIR):
+        self.root = root
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history')
+
+    def write(self, quotes_by_market, scrape_ts):
+        with METRICS.timed('persist'):
+            return [append_quotes(quotes, market, scrape_ts, self.root) for market, quotes in quotes_by_market.items()]
+
+    def submit(self, quotes_by_market, scrape_ts):
+        future = self.executor.submit(self.write, quotes_by_market, scrape_ts)
+        future.add_done_callback(report_write_error)
+        return future
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def report_write_error(future):
+    if future.exception() is not None:
+        print(f"Failed to append the poll to the odds history: {future.exception()}")
+
+
+def history_dataset(root=HISTORY_DIR):
+    return ds.dataset(root, format='parquet', partitioning=PARTITIONING, schema=HISTORY_SCHEMA.append(
+        pa.field('date', pa.string())).append(pa.field('market', pa.string())))
+
+
+def history_filter(market=None, game_ids=None, team=None, book=None, game_time=None, start=None, end=None):
+    # Builds a pyarrow filter, partition fields (date, market) prune whole directories
+    conditions = []
+    if market is not None:
+        conditions.append(ds.field('market') == market)
+    if game_ids is not None:
+        conditions.append(ds.field('game_id').isin(list(game_ids)))
+    if team is not None:
+        conditions.append(ds.field('team') == team)
+    if book is not None:
+        conditions.append(ds.field('book') == book)
+    if game_time is not None:
+        conditions.append(ds.field('time') == to_utc_timestamp(game_time))
+    if start is not None:
+        start = to_utc_timestamp(start)
+        conditions.append(ds.field('date') >= f'{start:%Y-%m-%d}')
+        conditions.append(ds.field('scrape_ts') >= start)
+    if end is not None:
+        end = to_utc_timestamp(end)
+        conditions.append(ds.field('date') <= f'{end:%Y-%m-%d}')
+        conditions.append(ds.field('scrape_ts') <= end)
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def scan_history(columns=None, root=HISTORY_DIR, batch_size=65536, **filters):
+    # Lazily yields record batches, only the matching partitions and row groups are read
+    if not os.path.isdir(root):
+        return
+    dataset = history_dataset(root)
+    yield from dataset.to_batches(columns=columns, filter=history_filter(**filters), batch_size=batch_size)
+
+
+def read_history(columns=None, root=HISTORY_DIR, **filters):
+    if not os.path.isdir(root):
+        return pd.DataFrame(columns=columns or [field.name for field in HISTORY_SCHEMA])
+    dataset = history_dataset(root)
+    return dataset.to_table(columns=columns, filter=history_filter(**filters)).to_pandas()
+
+
+def snapshot_paths(market, root=HISTORY_DIR):
+    # Snapshot files of a market, newest first; date partitions and file names both sort by scrape time
+    if not os.path.isdir(root):
+        return
+    for date_dir in sorted(os.listdir(root), reverse=True):
+        directory = os.path.join(root, date_dir, f'market={market}')
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted((name for name in os.listdir(directory) if name.endswith('.parquet')), reverse=True):
+            yield os.path.join(directory, name)
+
+
+def snapshot_time(path):
+    # Scrape time in the file name written by append_quotes
+    return pd.to_datetime(os.path.basename(path)[len('part-'):-len('.parquet')], format='%Y%m%dT%H%M%S%fZ', utc=True)
+
+
+def latest_snapshot_path(market, root=HISTORY_DIR):
+    return next(snapshot_paths(market, root), None)
+
+
+def read_quotes_file(path, market, filters=None):
+    quotes = pq.read_table(path, schema=HISTORY_SCHEMA, filters=filters).to_pandas()
+    # Files written before the game key existed cannot be aligned with new quotes
+    return as_quote_dtypes(quotes[quotes['game_id'].notna()].assign(market=market))
+
+
+def read_quotes_since(market, since, root=HISTORY_DIR):
+    # Every scrape of a market from `since` on, one frame per file, oldest first
+    since = to_utc_timestamp(since)
+    paths = []
+    for path in snapshot_paths(market, root):
+        if snapshot_time(path) < since:
+            break
+        paths.append(path)
+    return [read_quotes_file(path, market) for path in reversed(paths)]
+
+
+def read_latest_quotes(market, root=HISTORY_DIR, game_ids=None, max_files=288):
+    # Without game_ids this is the newest file. With game_ids, polls that only scraped some games are
+    # stitched together: walk back until every game has its most recent quotes (at most max_files files).
+    if game_ids is None:
+        path = latest_snapshot_path(market, root)
+        if path is None:
+            return empty_quotes()
+        return read_quotes_file(path, market)
+
+    missing = set(game_ids)
+    parts = []
+    for i, path in enumerate(snapshot_paths(market, root)):
+        if not missing or i >= max_files:
+            break
+        quotes = read_quotes_file(path, market, filters=[('game_id', 'in', list(missing))])
+        if not quotes.empty:
+            parts.append(quotes)
+            missing -= set(quotes['game_id'])
+    # Oldest first so every game's rows come out in a stable order
+    return concat_quotes(parts[::-1])
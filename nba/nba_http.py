@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+import queue
+import threading
+import httpx
+from selenium.common.exceptions import WebDriverException
+from nba.nba_metrics import METRICS
+from nba.nba_parser import is_signed_out, make_soup, parse_game_snapshots, parse_game_urls, \
+    parse_overview_fingerprints
+
+HTTP_COOKIES_FILE = 'http_cookies.json'
+HTTP_CONCURRENCY = 8
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+# Markets a game page must carry in its server-rendered HTML, moneyline is optional as on the browser path
+REQUIRED_MARKETS = ('spread', 'total')
+
+
+def load_cookies(path=HTTP_COOKIES_FILE):
+    try:
+        with open(path) as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        return None, set()
+    return saved.get('cookies'), set(saved.get('auth_cookies', []))
+
+
+def save_cookies(cookies, auth_cookies, path=HTTP_COOKIES_FILE):
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump({'cookies': cookies, 'auth_cookies': sorted(auth_cookies)}, file)
+    os.replace(temp_path, path)
+
+
+def needs_javascript(game):
+    # The server-rendered page is enough when the spread and total tables and the money percentages are in it,
+    # anything missing is only rendered client-side. A finished game (None) is final on either path.
+    if game is None:
+        return False
+    for market in REQUIRED_MARKETS:
+        if game[market] is None:
+            return True
+        records, _ = game[market]
+        if all(record['money_pc'] is None for record in records):
+            return True
+    return False
+
+
+class HttpSession:
+    # Same interface as ScraperSession, but pages are fetched over plain HTTP by one pooled async client and parsed
+    # without Chromium. The client and the event loop it runs on live as long as the session, so connections are
+    # kept alive across cycles. A browser is only started to log in (its cookies seed the client) and for the games
+    # whose HTML lacks data that needs JavaScript.
+    errors = (httpx.HTTPError, WebDriverException)
+
+    def __init__(self, BASE_URL, NBA, USERNAME, PASSWORD, concurrency=HTTP_CONCURRENCY, lean=True, cookies=None,
+                 cookies_file=HTTP_COOKIES_FILE, timeout=20):
+        self.base_url = BASE_URL
+        self.nba = NBA
+        self.username = USERNAME
+        self.password = PASSWORD
+        self.concurrency = concurrency
+        self.lean = lean
+        # None loads the saved cookies (or logs in), a dict (even empty) is used as is
+        self.cookies = cookies
+        self.auth_cookies = set()
+        self.cookies_file = cookies_file
+        self.timeout = timeout
+        self.browser = None
+        self.loop = None
+        self.thread = None
+        self.client = None
+        self.failed_urls = set()
+        self.browser_fallbacks = 0
+        self.parse_errors = 0
+        self.logins = 0
+
+    def start(self):
+        if self.cookies is None:
+            self.cookies, self.auth_cookies = load_cookies(self.cookies_file)
+        if self.cookies is None:
+            self.login()
+        return self
+
+    def browser_session(self):
+        # Started on demand, logging in on start. Its fresh session seeds the client, this run's next fetches and
+        # the next runs use it instead of falling back again.
+        if self.browser is None:
+            # Imported here, the browser scraper is only needed by this fallback
+            from nba.nba_scraper import ScraperSession
+            self.browser = ScraperSession(self.base_url, self.nba, self.username, self.password, 1, self.lean).start()
+            self.cookies = {cookie['name']: cookie['value'] for cookie in self.browser.pool.drivers[0].get_cookies()}
+            self.auth_cookies = self.browser.auth_cookies
+            save_cookies(self.cookies, self.auth_cookies, self.cookies_file)
+        return self.browser
+
+    def login(self):
+        # A browser still open may hold the expired session, a new one logs in again
+        self.close_browser()
+        self.browser_session()
+        self.logins += 1
+        # The browser is not needed again unless a page needs JavaScript
+        self.close_browser()
+
+    def is_logged_in(self):
+        # No cookies after a failed login or restart, the next cycle logs in
+        return self.cookies is not None and self.auth_cookies <= set(self.cookies)
+
+    def run(self, coroutine):
+        # The event loop thread is started on first use and runs until close()
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def http_client(self):
+        # Created on the loop thread it belongs to. The jar is reset to the session cookies on every fetch, a login
+        # in between replaces them.
+        if self.client is None:
+            limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+            self.client = httpx.AsyncClient(headers=HEADERS, limits=limits, timeout=self.timeout,
+                                            follow_redirects=True)
+        self.client.cookies = self.cookies
+        return self.client
+
+    async def fetch_all(self, urls, on_page=None):
+        # Pages (or the exception raised fetching them) in url order; on_page(index, page) is called as each
+        # one arrives
+        client = self.http_client()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(index, url):
+            async with semaphore:
+                try:
+                    with METRICS.timed('http_fetch', url=url) as fields:
+                        response = await client.get(url)
+                        response.raise_for_status()
+                        fields['bytes'] = len(response.content)
+                        page = response.text
+                except Exception as e:
+                    page = e
+            if on_page is not None:
+                on_page(index, page)
+            return page
+
+        pages = await asyncio.gather(*(fetch(index, url) for index, url in enumerate(urls)))
+        # The site may rotate its session cookies or expire them, keep the jar as it is now for the next cycle
+        self.cookies = {cookie.name: cookie.value for cookie in client.cookies.jar}
+        METRICS.increment('page_bytes', sum(len(page) for page in pages if isinstance(page, str)))
+        return pages
+
+    def fetch_pages(self, urls):
+        return self.run(self.fetch_all(urls)).result()
+
+    def stream_pages(self, urls):
+        # (index, page) pairs as the fetches complete on the loop thread
+        pages = queue.Queue()
+
+        def done(future):
+            if not future.cancelled() and future.exception() is not None:
+                pages.put((None, future.exception()))
+
+        future = self.run(self.fetch_all(urls, on_page=lambda index, page: pages.put((index, page))))
+        future.add_done_callback(done)
+        for _ in urls:
+            index, page = pages.get()
+            if index is None:
+                raise page
+            yield index, page
+        future.result()
+
+    def fetch_overview(self, url):
+        page = self.fetch_pages([url])[0]
+        if isinstance(page, Exception):
+            raise page
+        return make_soup(page)
+
+    def read_overview(self):
+        if not self.is_logged_in():
+            print("Session expired, logging in again...")
+            self.login()
+        url = self.base_url + self.nba
+        soup = self.fetch_overview(url)
+        # Cookie names alone do not tell that the server ended the session, the page does
+        if self.auth_cookies and is_signed_out(soup):
+            print("Session expired on the server, logging in again...")
+            self.login()
+            soup = self.fetch_overview(url)
+        game_urls = parse_game_urls(soup, base_url=url)
+        fingerprints = parse_overview_fingerprints(soup, base_url=url)
+        # Games the fingerprinting could not delimit get None and are always deep scraped
+        return game_urls, {game_url: fingerprints.get(game_url) for game_url in game_urls}
+
+    def list_games(self):
+        return self.read_overview()[0]
+
+    def stream_games(self, game_urls):
+        # (url, game) pairs as each page is fetched and parsed, failed games come out as None and in failed_urls
+        self.failed_urls = set()
+        needs_browser = []
+        for index, page in self.stream_pages(game_urls):
+            url = game_urls[index]
+            if isinstance(page, Exception):
+                print(f"Failed to fetch {url}: {page}")
+                self.failed_urls.add(url)
+                yield url, None
+                continue
+            try:
+                with METRICS.timed('parse_game', game=url):
+                    game = parse_game_snapshots({'bets': page})
+            except Exception as e:
+                # One malformed page fails its game only, as a failed scrape does on the browser path
+                print(f"Failed to parse {url}: {e}")
+                METRICS.increment('parse_errors')
+                self.parse_errors += 1
+                self.failed_urls.add(url)
+                yield url, None
+                continue
+            if needs_javascript(game):
+                needs_browser.append(url)
+            else:
+                yield url, game
+
+        if needs_browser:
+            # Only these games pay for a browser, the trends or odds tabs they lack are rendered client-side
+            print(f"{len(needs_browser)} of {len(game_urls)} games need the browser")
+            self.browser_fallbacks += len(needs_browser)
+            browser = self.browser_session()
+            for url, game in browser.stream_games(needs_browser):
+                if url in browser.failed_urls:
+                    self.failed_urls.add(url)
+                yield url, game
+
+    def scrape_games(self, game_urls):
+        games = dict(self.stream_games(game_urls))
+        return [games.get(url) for url in game_urls]
+
+    def restart(self):
+        # Log in again on the next cycle, on fresh connections
+        self.close_browser()
+        self.close_client()
+        self.cookies, self.auth_cookies = None, set()
+        self.start()
+
+    def close_browser(self):
+        if self.browser is not None:
+            self.browser.close()
+            self.browser = None
+
+    def close_client(self):
+        if self.client is not None:
+            client, self.client = self.client, None
+            try:
+                self.run(client.aclose()).result()
+            except Exception as e:
+                print(f"Failed to close the HTTP client: {e!r}")
+
+    def close(self):
+        self.close_browser()
+        self.close_client()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = self.thread = None
+        if self.cookies is not None:
+            save_cookies(self.cookies, self.auth_cookies, self.cookies_file)
@@ -0,0 +1,196 @@
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import pytz
+
+METRICS_DIR = os.environ.get('NBA_METRICS_DIR', 'metrics')
+JSONL_FILE = 'metrics.jsonl'
+PROMETHEUS_FILE = 'nba.prom'
+
+# Labels that identify a single game or page; kept in the JSON lines but not in the Prometheus series
+HIGH_CARDINALITY_LABELS = ('game', 'url')
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    # Wall time, call and error counters per stage. Totals live for the whole process (Prometheus counters),
+    # individual events are kept until the end of the polling cycle for the JSON lines.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = {}
+        self.counters = {}
+        # This cycle's counts with every label, the game included, for the JSON lines
+        self.cycle_counters = {}
+        self.gauges = {}
+        self.events = []
+
+    def current_labels(self):
+        return getattr(self.local, 'labels', {})
+
+    @contextmanager
+    def labels(self, **labels):
+        # Labels inherited by everything recorded in this thread, e.g. the game a worker is scraping
+        previous = self.current_labels()
+        self.local.labels = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    @contextmanager
+    def timed(self, stage, **labels):
+        # Yields a dict for values measured along the way (e.g. bytes), they go into the event, not the labels
+        labels = {**self.current_labels(), **labels}
+        fields = {}
+        start = time.perf_counter()
+        error = None
+        try:
+            yield fields
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, error, fields, **labels)
+
+    def record(self, stage, seconds, error=None, fields=None, **labels):
+        key = (stage, tuple(sorted((name, str(value)) for name, value in labels.items()
+                                   if name not in HIGH_CARDINALITY_LABELS)))
+        with self.lock:
+            totals = self.stages.setdefault(key, {'count': 0, 'errors': 0, 'seconds': 0.0, 'last': 0.0, 'max': 0.0})
+            totals['count'] += 1
+            totals['errors'] += error is not None
+            totals['seconds'] += seconds
+            totals['last'] = seconds
+            totals['max'] = max(totals['max'], seconds)
+            self.events.append({'stage': stage, 'seconds': round(seconds, 4), 'error': error, **labels, **(fields or {})})
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items()
+                                  if label not in HIGH_CARDINALITY_LABELS)))
+        cycle_key = (name, tuple(sorted((label, str(value))
+                                        for label, value in {**self.current_labels(), **labels}.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            self.cycle_counters[cycle_key] = self.cycle_counters.get(cycle_key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        # Latest value of something that goes up and down, e.g. a browser's memory
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items()
+                                  if label not in HIGH_CARDINALITY_LABELS)))
+        with self.lock:
+            self.gauges[key] = value
+
+    def stage_seconds(self, stage):
+        # Total wall time of a stage over all its label sets since the process started
+        with self.lock:
+            return sum(totals['seconds'] for (name, _), totals in self.stages.items() if name == stage)
+
+    def slow_games(self, top=5):
+        # Per game total time and the single slowest stage (e.g. which selector wait burned the timeout)
+        games = {}
+        for event in self.events:
+            game = event.get('game')
+            if not game:
+                continue
+            entry = games.setdefault(game, {'game': game, 'seconds': 0.0, 'slowest': None})
+            if event['stage'] == 'extract_game_data':
+                entry['seconds'] += event['seconds']
+            elif entry['slowest'] is None or event['seconds'] > entry['slowest']['seconds']:
+                entry['slowest'] = {key: value for key, value in event.items() if key != 'game'}
+        return sorted(games.values(), key=lambda entry: entry['seconds'], reverse=True)[:top]
+
+    def cycle_summary(self):
+        summary = {}
+        for event in self.events:
+            stage = summary.setdefault(event['stage'], {'count': 0, 'errors': 0, 'seconds': 0.0})
+            stage['count'] += 1
+            stage['errors'] += event['error'] is not None
+            stage['seconds'] = round(stage['seconds'] + event['seconds'], 4)
+            if 'bytes' in event:
+                stage['bytes'] = stage.get('bytes', 0) + event['bytes']
+        return summary
+
+    def write_jsonl(self, path, **cycle_labels):
+        with self.lock:
+            events = list(self.events)
+            # One entry per name and label set: the cycle's counts per game, the latest gauges
+            counters, gauges = ([{'name': name, 'labels': dict(labels), 'value': value}
+                                 for (name, labels), value in sorted(values.items())]
+                                for values in (self.cycle_counters, self.gauges))
+        timestamp = datetime.now(pytz.utc).isoformat()
+        with open(path, 'a') as file:
+            for event in events:
+                file.write(json.dumps({'type': 'event', 'ts': timestamp, **cycle_labels, **event}, default=str) + '\n')
+            file.write(json.dumps({'type': 'cycle', 'ts': timestamp, **cycle_labels, 'stages': self.cycle_summary(),
+                                   'counters': counters, 'gauges': gauges, 'slow_games': self.slow_games()},
+                                  default=str) + '\n')
+
+    def prometheus_text(self):
+        lines = []
+        series = [
+            ('nba_stage_seconds_total', 'counter', 'Wall time spent in each stage', 'seconds'),
+            ('nba_stage_calls_total', 'counter', 'Number of times each stage ran', 'count'),
+            ('nba_stage_errors_total', 'counter', 'Number of times each stage raised', 'errors'),
+            ('nba_stage_last_seconds', 'gauge', 'Wall time of the latest run of each stage', 'last'),
+            ('nba_stage_max_seconds', 'gauge', 'Slowest run of each stage', 'max'),
+        ]
+        with self.lock:
+            stages = dict(self.stages)
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        for name, kind, description, field in series:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (stage, labels), totals in sorted(stages.items()):
+                label_text = ','.join([f'stage="{escape_label(stage)}"'] +
+                                      [f'{label}="{escape_label(value)}"' for label, value in labels])
+                lines.append(f'{name}{{{label_text}}} {totals[field]}')
+        # One HELP and TYPE line per metric family, the textfile collector rejects a family declared twice
+        for values, kind, suffix in ((counters, 'counter', '_total'), (gauges, 'gauge', '')):
+            for name, family in itertools.groupby(sorted(values.items()), key=lambda item: item[0][0]):
+                metric = f'nba_{name}{suffix}'
+                lines.append(f'# HELP {metric} {name.replace("_", " ").capitalize()}')
+                lines.append(f'# TYPE {metric} {kind}')
+                for (_, labels), value in family:
+                    label_text = ','.join(f'{label}="{escape_label(value)}"' for label, value in labels)
+                    lines.append(f'{metric}{{{label_text}}} {value}' if label_text else f'{metric} {value}')
+        lines.append('# TYPE nba_last_cycle_timestamp_seconds gauge')
+        lines.append(f'nba_last_cycle_timestamp_seconds {time.time():.3f}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # Written atomically, node exporter's textfile collector may read it at any time
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+    def flush_cycle(self, directory=METRICS_DIR, prometheus_file=PROMETHEUS_FILE, **cycle_labels):
+        # Separate processes (scraper, Telegram sender) need their own textfile, they would overwrite each other
+        os.makedirs(directory, exist_ok=True)
+        self.write_jsonl(os.path.join(directory, JSONL_FILE), **cycle_labels)
+        self.write_prometheus(os.path.join(directory, prometheus_file))
+        pages = self.cycle_summary().get('page_load')
+        if pages:
+            print(f"Loaded {pages['count']} pages, {pages['seconds'] / pages['count']:.2f}s"
+                  + (f" and {pages['bytes'] / pages['count'] / 1024:.0f} KB" if 'bytes' in pages else '') + " per page")
+        slow_games = self.slow_games(top=3)
+        for entry in slow_games:
+            slowest = entry['slowest'] or {}
+            print(f"Slow game {entry['game']}: {entry['seconds']:.1f}s, slowest step {slowest.get('stage')} "
+                  f"{slowest.get('selector', '')} {slowest.get('seconds', 0):.1f}s")
+        with self.lock:
+            self.events = []
+            self.cycle_counters = {}
+
+
+METRICS = Metrics()
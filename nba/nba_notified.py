@@ -0,0 +1,73 @@
+import csv
+import heapq
+import os
+from datetime import datetime
+import pandas as pd
+import pytz
+
+NOTIFIED_MOVEMENTS_FILE = 'notified_movements.csv'
+
+
+def to_utc_timestamp(value):
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        return timestamp.tz_localize('UTC')
+    return timestamp.tz_convert('UTC')
+
+
+class NotifiedStore:
+    # Identifiers of already notified opportunities, kept in memory with O(1) lookups.
+    # Entries expire once their game has started and the file is only rewritten on flush.
+
+    def __init__(self, path=NOTIFIED_MOVEMENTS_FILE):
+        self.path = path
+        self.times = {}
+        self.expiry_heap = []
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path=NOTIFIED_MOVEMENTS_FILE, now=None):
+        store = cls(path)
+        try:
+            with open(path, newline='') as file:
+                for row in csv.DictReader(file):
+                    if row.get('identifier') and row.get('time'):
+                        store.add(row['identifier'], row['time'])
+        except FileNotFoundError:
+            pass
+        store.dirty = False
+        store.evict_past_events(now)
+        return store
+
+    def __contains__(self, identifier):
+        return identifier in self.times
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, identifier, time):
+        time = to_utc_timestamp(time)
+        self.times[identifier] = time
+        heapq.heappush(self.expiry_heap, (time, identifier))
+        self.dirty = True
+
+    def evict_past_events(self, now=None):
+        current_time = to_utc_timestamp(now if now is not None else datetime.now(pytz.utc))
+        while self.expiry_heap and self.expiry_heap[0][0] <= current_time:
+            time, identifier = heapq.heappop(self.expiry_heap)
+            # Skip stale heap entries of identifiers that were re-added with another time
+            if self.times.get(identifier) == time:
+                del self.times[identifier]
+                self.dirty = True
+
+    def flush(self):
+        if not self.dirty:
+            return
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['identifier', 'time'])
+            for identifier, time in self.times.items():
+                writer.writerow([identifier, time.isoformat()])
+        os.replace(temp_path, self.path)
+        self.dirty = False
@@ -0,0 +1,233 @@
+import hashlib
+import os
+from datetime import datetime
+from urllib.parse import urljoin
+import pandas as pd
+from bs4 import BeautifulSoup
+from nba.nba_helper_functions import convert_percentage_to_decimal, parse_american_odds, parse_total_points, \
+    build_market_records
+from nba.nba_quotes import snapshot_to_quotes
+
+# lxml is much faster than the pure Python parser, fall back to it only if lxml is missing
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+GAME_TIME_SELECTOR = ('body > div.event-header.module > div:nth-child(1) > div > div.event-header-score > div > span '
+                      '> span:nth-child(2)')
+GAME_LINK_SELECTOR = "ul.nav > li.nav-item.buttons > a.button.matte.rounded"
+# Header toggle that only shows for visitors who are not signed in
+SIGN_IN_SELECTOR = "body > header > div.page-social > span"
+
+# CSS selectors to dynamically target the rows for both teams
+ROW_SELECTORS = ["tr.divided", "tr.footer"]
+
+# Cell selectors (relative to a team row of the trends tables) for each market
+BETS_PC_CELLS = {'spread': "td:nth-child(2) > div", 'total': "td:nth-child(3) > div", 'moneyline': "td:nth-child(4)"}
+MONEY_PC_CELLS = {'spread': "td:nth-child(2)", 'total': "td:nth-child(3)", 'moneyline': "td:nth-child(4)"}
+
+# Odds table layout of each market; moneyline quotes have no line, only the price
+MARKETS = {
+    'spread': {'table_id': 'odds-table-spread--0', 'line_class': '.data-value', 'odds_class': '.data-odds',
+               'parse_line': float, 'line_column': 'spread'},
+    'total': {'table_id': 'odds-table-total--0', 'line_class': '.data-value', 'odds_class': '.data-odds',
+              'parse_line': parse_total_points, 'line_column': 'total'},
+    'moneyline': {'table_id': 'odds-table-moneyline--0', 'line_class': None, 'odds_class': '.data-moneyline',
+                  'parse_line': None, 'line_column': None},
+}
+
+
+def make_soup(source):
+    # Accepts a BeautifulSoup object, raw HTML or the path of a saved HTML file
+    if isinstance(source, BeautifulSoup):
+        return source
+    if isinstance(source, os.PathLike) or (isinstance(source, str) and '<' not in source and os.path.isfile(source)):
+        with open(source, 'rb') as file:
+            source = file.read()
+    return BeautifulSoup(source, HTML_PARSER)
+
+
+def element_text(element):
+    if element is None:
+        return None
+    return element.get_text(" ", strip=True)
+
+
+def is_signed_out(soup):
+    # The page was served to a visitor, e.g. the session expired on the server while its cookies were kept
+    return (element_text(soup.select_one(SIGN_IN_SELECTOR)) or '').lower() == 'sign in'
+
+
+def parse_game_time(soup):
+    # Time element, also a de-facto check for game status
+    time_element = soup.select_one(GAME_TIME_SELECTOR)
+    if time_element is None:
+        print("Time element not found, indicating the game may be over. Skipping...")
+        return None
+
+    # If the 'data-value' attribute is missing, it indicates the game is over.
+    iso_datetime_str = time_element.get('data-value')
+    if not iso_datetime_str:
+        print("Game datetime not available, indicating the game may be over. Skipping...")
+        return None
+
+    return datetime.fromisoformat(iso_datetime_str.replace('Z', '+00:00'))
+
+
+def parse_trend_column(soup, table_id, cells):
+    # Returns {market: [team 1 percentage, team 2 percentage]}, None where the cell is missing
+    trends = {market: [None, None] for market in cells}
+    table = soup.select_one(f"#{table_id}")
+    if table is None:
+        return trends
+    for i in range(2):
+        for market, cell in cells.items():
+            element = table.select_one(f":scope > tr:nth-child({i + 2}) > {cell}")
+            trends[market][i] = convert_percentage_to_decimal(element_text(element))
+    return trends
+
+
+def parse_trends(bets_soup, money_soup=None):
+    bets = parse_trend_column(bets_soup, 'trends-table-bets--0', BETS_PC_CELLS)
+    money = parse_trend_column(money_soup if money_soup is not None else bets_soup, 'trends-table-money--0',
+                               MONEY_PC_CELLS)
+    return {market: [{'bets_pc': bets[market][i], 'money_pc': money[market][i]} for i in range(2)]
+            for market in BETS_PC_CELLS}
+
+
+def parse_odds_table(soup, table_id, line_class=None, odds_class='.data-odds', parse_line=float):
+    table = soup.select_one(f"#{table_id}")
+    if table is None:
+        return None
+
+    # Extract bookmakers
+    header = table.select_one("tr:first-child")
+    bookmakers = [img.get('alt') for img in header.select("th.book-logo img") if img.get('alt')] if header else []
+
+    rows = []
+    for row_selector in ROW_SELECTORS:
+        team_element = table.select_one(f":scope > {row_selector}")
+        if team_element is None:
+            return None
+        # Extract team name using the image alt attribute
+        team_img_element = team_element.select_one("td.game-team > div > img")
+        team = team_img_element.get('alt') if team_img_element else None
+
+        # Extract lines and odds
+        odds = [element_text(el) or 'NaN' for el in team_element.select(f".game-odds {odds_class}")]
+        if line_class:
+            lines = [element_text(el) or 'NaN' for el in team_element.select(f".game-odds {line_class}")]
+        else:
+            lines = [None] * len(odds)
+
+        # cleaning, keeping the bookmaker of every quote aligned with its own row
+        quotes = {}
+        for val, line, bookmaker in zip(odds, lines, bookmakers):
+            if val in ['N/A', 'PK'] or line in ['N/A', 'PK']:
+                continue
+            quotes[bookmaker] = (parse_line(line) if line_class else None, parse_american_odds(val))
+        rows.append((team, quotes))
+
+    return bookmakers, rows
+
+
+def parse_market(soup, market, game_time, trends):
+    layout = MARKETS[market]
+    table = parse_odds_table(soup, layout['table_id'], layout['line_class'], layout['odds_class'],
+                             layout['parse_line'])
+    if table is None:
+        return None
+    bookmakers, rows = table
+    return build_market_records(game_time, rows, trends[market], layout['line_column'], bookmakers), \
+        bookmakers
+
+
+def parse_game_snapshots(snapshots):
+    # snapshots maps a page state to its HTML (or saved file):
+    #   'bets' - the page as loaded (spread tab and bets trends), required
+    #   'money' - after switching the trends to the money view
+    #   'total', 'moneyline' - after opening the respective odds tab
+    # Missing states fall back to the loaded page, so a single saved page can be parsed on its own.
+    soups = {state: make_soup(source) for state, source in snapshots.items() if source is not None}
+    bets_soup = soups['bets']
+
+    game_time = parse_game_time(bets_soup)
+    if game_time is None:
+        return None
+
+    trends = parse_trends(bets_soup, soups.get('money'))
+    return {
+        'time': game_time,
+        'spread': parse_market(soups.get('spread', bets_soup), 'spread', game_time, trends),
+        'total': parse_market(soups.get('total', bets_soup), 'total', game_time, trends),
+        'moneyline': parse_market(soups.get('moneyline', bets_soup), 'moneyline', game_time, trends),
+    }
+
+
+def parse_game_urls(source, base_url=None):
+    # Matchup links of every game in the overview odds table
+    soup = make_soup(source)
+    table = soup.select_one("#odds-table-spread--0")
+    if table is None:
+        return []
+
+    game_urls = []
+    for game_link_element in table.select("td.game-links"):
+        matchup_link_element = game_link_element.select_one(GAME_LINK_SELECTOR)
+        url = matchup_link_element.get('href') if matchup_link_element else None
+        # Ensure the URL is not None or empty before adding to the list
+        if url:
+            game_urls.append(urljoin(base_url, url) if base_url else url)
+    return game_urls
+
+
+def parse_overview_fingerprints(source, base_url=None):
+    # Hash of the lines and odds every book shows for a game on the overview table, keyed by matchup url.
+    # A game spans the rows from its 'divided' row to its 'footer' row, like on the matchup page.
+    soup = make_soup(source)
+    table = soup.select_one("#odds-table-spread--0")
+    if table is None:
+        return {}
+
+    fingerprints = {}
+    url, cells = None, []
+
+    def close_game():
+        if url:
+            fingerprints[url] = hashlib.sha1('|'.join(cells).encode()).hexdigest()
+
+    for row in table.find_all('tr'):
+        classes = row.get('class') or []
+        link_element = row.select_one(f"td.game-links {GAME_LINK_SELECTOR}")
+        row_url = link_element.get('href') if link_element else None
+        if row_url and base_url:
+            row_url = urljoin(base_url, row_url)
+        # A new game starts on a 'divided' row, or on a second link within the same group
+        if 'divided' in classes or (row_url and url and row_url != url):
+            close_game()
+            url, cells = None, []
+        url = url or row_url
+        cells.extend(element_text(el) or '' for el in row.select(".game-odds .data-value, .game-odds .data-odds"))
+        if 'footer' in classes:
+            close_game()
+            url, cells = None, []
+    close_game()
+    return fingerprints
+
+
+def combine_game_results(results, scrape_ts=None):
+    # Merge per-game results, in game order, into one long quotes frame per market
+    all_data = {market: [] for market in MARKETS}
+    for game in results:
+        if not game:  # Game already started, is over or failed to scrape
+            continue
+
+        for market in MARKETS:
+            if game.get(market) is None:  # e.g. no moneyline tab on this page
+                continue
+            current_data, _ = game[market]
+            all_data[market].extend(current_data)
+
+    return {market: snapshot_to_quotes(pd.DataFrame(data), market, scrape_ts) for market, data in all_data.items()}
@@ -0,0 +1,144 @@
+import json
+import os
+from datetime import datetime, timedelta
+import pytz
+
+OVERVIEW_FINGERPRINTS_FILE = 'overview_fingerprints.json'
+
+# (minutes before tipoff, seconds between polls), the first matching tier wins
+POLLING_TIERS = [
+    (30, 30),
+    (120, 60),
+    (360, 300),
+    (1440, 900),
+    (None, 3600),
+]
+# Polls in a row without a start time (started game, error or interstitial page) before a game is retired
+MAX_MISSES = int(os.environ.get('NBA_MAX_MISSES', '3'))
+
+
+class TipoffScheduler:
+    # Gives every game its own polling interval based on how close it is to tipoff
+
+    def __init__(self, tiers=POLLING_TIERS, max_misses=MAX_MISSES):
+        self.tiers = tiers
+        self.max_misses = max_misses
+        self.games = {}
+        # Games that have started stay retired as long as the overview still lists them
+        self.retired = set()
+
+    def interval_for(self, game_time, now):
+        if game_time is None:
+            return self.tiers[0][1]
+        minutes_to_tipoff = (game_time - now).total_seconds() / 60
+        for max_minutes, seconds in self.tiers:
+            if max_minutes is None or minutes_to_tipoff <= max_minutes:
+                return seconds
+        return self.tiers[-1][1]
+
+    def sync(self, game_urls, now=None):
+        # New games are due straight away, games gone from the overview are forgotten
+        now = now or datetime.now(pytz.utc)
+        listed = set(game_urls)
+        for url in game_urls:
+            if url not in self.games and url not in self.retired:
+                self.games[url] = {'time': None, 'next_due': now, 'interval': self.tiers[0][1], 'misses': 0}
+        for url in list(self.games):
+            if url not in listed:
+                del self.games[url]
+        self.retired &= listed
+
+    def due(self, now=None, budget=None):
+        # Most overdue first, relative to each game's own interval, so games near tipoff win the budget
+        now = now or datetime.now(pytz.utc)
+        due_games = [(url, game) for url, game in self.games.items() if game['next_due'] <= now]
+        due_games.sort(key=lambda item: (now - item[1]['next_due']).total_seconds() / item[1]['interval'],
+                       reverse=True)
+        urls = [url for url, _ in due_games]
+        return urls[:budget] if budget else urls
+
+    def record(self, url, game_time, now=None):
+        # game_time is None when the matchup page shows no start time: the game started, or the page was an
+        # error or interstitial. Only a start time in the past or max_misses misses in a row retire the game.
+        now = now or datetime.now(pytz.utc)
+        game = self.games.get(url)
+        if game is None:
+            return
+        if game_time is None:
+            game['misses'] += 1
+            known_time = game['time']
+            if game['misses'] >= self.max_misses or (known_time is not None and known_time <= now):
+                self.retire(url)
+            else:
+                game['next_due'] = now + timedelta(seconds=self.interval_for(known_time, now))
+            return
+        if game_time <= now:
+            self.retire(url)
+            return
+        interval = self.interval_for(game_time, now)
+        game.update({'time': game_time, 'next_due': now + timedelta(seconds=interval), 'interval': interval,
+                     'misses': 0})
+
+    def retire(self, url):
+        del self.games[url]
+        self.retired.add(url)
+
+    def report(self, now=None):
+        # Queue depth and how far behind schedule every due game is, in seconds
+        now = now or datetime.now(pytz.utc)
+        lag = {url: (now - game['next_due']).total_seconds() for url, game in self.games.items()
+               if game['next_due'] <= now}
+        return {'tracked': len(self.games), 'queue_depth': len(lag), 'retired': len(self.retired), 'lag': lag}
+
+
+class OverviewTracker:
+    # Remembers the overview fingerprint of every game at its last deep scrape. The overview only shows
+    # lines and odds, so bets/money trends need a forced refresh every refresh_seconds (None to disable).
+
+    def __init__(self, refresh_seconds=900):
+        self.refresh_seconds = refresh_seconds
+        self.fingerprints = {}
+        self.last_deep_scrape = {}
+
+    def select(self, fingerprints, now=None):
+        # Games that are new, whose overview row changed, or whose trends are due for a refresh
+        now = now or datetime.now(pytz.utc)
+        selected = []
+        for url, fingerprint in fingerprints.items():
+            last_scrape = self.last_deep_scrape.get(url)
+            if fingerprint is None or self.fingerprints.get(url) != fingerprint or last_scrape is None:
+                selected.append(url)
+            elif self.refresh_seconds is not None and (now - last_scrape).total_seconds() >= self.refresh_seconds:
+                selected.append(url)
+        return selected
+
+    def record(self, url, fingerprint, now=None):
+        # Only called after a successful deep scrape, so failed games are picked again next time
+        self.fingerprints[url] = fingerprint
+        self.last_deep_scrape[url] = now or datetime.now(pytz.utc)
+
+    def forget_missing(self, fingerprints):
+        for url in list(self.fingerprints):
+            if url not in fingerprints:
+                del self.fingerprints[url]
+                self.last_deep_scrape.pop(url, None)
+
+    @classmethod
+    def load(cls, path=OVERVIEW_FINGERPRINTS_FILE, refresh_seconds=900):
+        tracker = cls(refresh_seconds)
+        try:
+            with open(path) as file:
+                games = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return tracker
+        for url, game in games.items():
+            tracker.record(url, game['fingerprint'], datetime.fromisoformat(game['last_deep_scrape']))
+        return tracker
+
+    def save(self, path=OVERVIEW_FINGERPRINTS_FILE):
+        games = {url: {'fingerprint': fingerprint, 'last_deep_scrape': self.last_deep_scrape[url].isoformat()}
+                 for url, fingerprint in self.fingerprints.items()}
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(games, file, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
@@ -0,0 +1,226 @@
+import os
+import queue
+import threading
+import time
+from selenium.common.exceptions import WebDriverException
+from nba.nba_driver import process_tree_rss
+from nba.nba_game import extract_game_data
+from nba.nba_helper_functions import initialize_webdriver, load_page
+from nba.nba_metrics import METRICS
+
+# A browser is replaced after this many pages or once its process tree uses this much memory, 0 disables the limit
+DRIVER_MAX_PAGES = int(os.environ.get('NBA_DRIVER_MAX_PAGES', '200'))
+DRIVER_MAX_RSS_MB = int(os.environ.get('NBA_DRIVER_MAX_RSS_MB', '1500'))
+
+
+class ManagedDriver:
+    # One Chrome behind a handle that outlives it: the browser is recycled past the page or memory limit and
+    # restarted when its session dies, with the login cookies put back either way. Everything else is passed
+    # through to the current webdriver.
+
+    def __init__(self, lean=False, max_pages=DRIVER_MAX_PAGES, max_rss_mb=DRIVER_MAX_RSS_MB, worker=0):
+        self.driver = None
+        self.lean = lean
+        self.max_pages = max_pages
+        self.max_rss = max_rss_mb * 2 ** 20
+        self.worker = worker
+        self.cookies = []
+        self.cookie_url = None
+        self.pages = 0
+        self.rss = None
+        self.peak_rss = 0
+        self.restarts = 0
+        self.recycles = 0
+
+    def __getattr__(self, name):
+        driver = self.__dict__.get('driver')
+        if driver is None:
+            raise AttributeError(name)
+        return getattr(driver, name)
+
+    def start(self):
+        self.driver = initialize_webdriver(self.lean)
+        if self.driver is None:
+            raise RuntimeError("Could not start a webdriver")
+        self.pages = 0
+        if self.cookies:
+            self.restore_session()
+        return self
+
+    def remember_session(self, cookies, url):
+        self.cookies = cookies
+        self.cookie_url = url
+
+    def restore_session(self):
+        # Cookies can only be set for the domain currently loaded
+        load_page(self.driver, self.cookie_url)
+        for cookie in self.cookies:
+            self.driver.add_cookie(cookie)
+
+    def is_alive(self):
+        if self.driver is None:
+            return False
+        try:
+            self.driver.current_url
+        except WebDriverException:
+            return False
+        return True
+
+    def quit(self):
+        if self.driver is None:
+            return
+        try:
+            self.driver.quit()
+        except Exception as e:
+            print(f"An error occurred while closing a webdriver: {e}")
+        self.driver = None
+
+    def replace(self):
+        self.quit()
+        self.start()
+
+    def recycle(self, reason):
+        # Keep the latest cookies, the site may have rotated them since the login
+        if self.cookies:
+            self.cookies = self.driver.get_cookies()
+        print(f"Recycling webdriver {self.worker} after {self.pages} pages ({reason})")
+        self.recycles += 1
+        METRICS.increment('driver_recycles', worker=self.worker)
+        self.replace()
+
+    def check_limits(self):
+        try:
+            self.rss = process_tree_rss(self.driver.service.process.pid)
+        except AttributeError:
+            self.rss = None
+        if self.rss is not None:
+            self.peak_rss = max(self.peak_rss, self.rss)
+            METRICS.gauge('driver_rss_bytes', self.rss, worker=self.worker)
+            METRICS.gauge('driver_peak_rss_bytes', self.peak_rss, worker=self.worker)
+        if self.max_pages and self.pages >= self.max_pages:
+            self.recycle(f"page limit {self.max_pages}")
+        elif self.max_rss and self.rss is not None and self.rss >= self.max_rss:
+            self.recycle(f"{self.rss / 2 ** 20:.0f} MB")
+
+    def run(self, task):
+        # task(driver) on the current browser; if it failed because the browser died, on a new one, once
+        if self.driver is None:
+            self.start()
+        try:
+            result = task(self.driver)
+        except WebDriverException as e:
+            if self.is_alive():
+                raise
+            print(f"Webdriver {self.worker} died ({e.msg}), restarting it and retrying")
+            self.restarts += 1
+            METRICS.increment('driver_crash_restarts', worker=self.worker)
+            self.replace()
+            result = task(self.driver)
+        self.pages += 1
+        try:
+            self.check_limits()
+        except Exception as e:
+            # The page is scraped, a failed recycle only costs this browser: the next task starts a new one
+            print(f"Recycling webdriver {self.worker} failed ({e}), starting a new one for the next game")
+            METRICS.increment('driver_recycle_failures', worker=self.worker)
+            self.quit()
+        return result
+
+
+class DriverPool:
+    # A fixed set of headless drivers that pull game urls from a shared queue
+
+    def __init__(self, size=1, lean=False):
+        self.size = max(1, size)
+        self.lean = lean
+        self.drivers = []
+        # Urls that raised during the last scrape, as opposed to games that are over
+        self.failed_urls = set()
+
+    def start(self):
+        for worker in range(self.size):
+            try:
+                self.drivers.append(ManagedDriver(self.lean, worker=worker).start())
+            except RuntimeError as e:
+                print(f"Webdriver {worker} did not start: {e}")
+        if not self.drivers:
+            raise RuntimeError("Could not start any webdriver for the scraping pool")
+        print(f"Started {len(self.drivers)} of {self.size} webdrivers")
+        return self
+
+    def share_session(self, source_driver, url):
+        # Log in once and copy the session cookies to every other worker, each keeps them for its next browser
+        cookies = source_driver.get_cookies()
+        for driver in self.drivers:
+            driver.remember_session(cookies, url)
+            if driver is not source_driver:
+                driver.restore_session()
+
+    def stream(self, game_urls, extract=extract_game_data):
+        # Yields (index, url, game) as soon as each game is extracted, in completion order
+        url_queue = queue.Queue()
+        for index, url in enumerate(game_urls):
+            url_queue.put((index, url))
+        done = queue.Queue()
+
+        self.failed_urls = set()
+        stats = [{'games': 0, 'errors': 0, 'seconds': 0.0} for _ in self.drivers]
+
+        def work(worker_id, driver):
+            while True:
+                try:
+                    index, url = url_queue.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.perf_counter()
+                game = None
+                try:
+                    with METRICS.labels(game=url, worker=worker_id), METRICS.timed('extract_game_data'):
+                        game = driver.run(lambda current: extract(current, url))
+                except Exception as e:
+                    print(f"Worker {worker_id} failed to scrape {url}: {e}")
+                    self.failed_urls.add(url)
+                    stats[worker_id]['errors'] += 1
+                stats[worker_id]['games'] += 1
+                stats[worker_id]['seconds'] += time.perf_counter() - start
+                done.put((index, url, game))
+
+        threads = [threading.Thread(target=work, args=(worker_id, driver), daemon=True)
+                   for worker_id, driver in enumerate(self.drivers)]
+        run_start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in game_urls:
+                yield done.get()
+        finally:
+            # The caller stopped early, the workers finish their current game and take no new one
+            while not url_queue.empty():
+                try:
+                    url_queue.get_nowait()
+                except queue.Empty:
+                    break
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - run_start
+
+        for worker_id, worker_stats in enumerate(stats):
+            games, seconds = worker_stats['games'], worker_stats['seconds']
+            rate = games / seconds * 60 if seconds else 0.0
+            driver = self.drivers[worker_id]
+            print(f"Worker {worker_id}: {games} games ({worker_stats['errors']} errors) in {seconds:.1f}s, "
+                  f"{rate:.1f} games/min, {driver.recycles} recycles, {driver.restarts} restarts"
+                  + (f", peak {driver.peak_rss / 2 ** 20:.0f} MB" if driver.peak_rss else ""))
+        print(f"Scraped {len(game_urls)} games with {len(self.drivers)} workers in {elapsed:.1f}s")
+
+    def scrape(self, game_urls, extract=extract_game_data):
+        # Results are stored by position so the merged output does not depend on worker timing
+        results = [None] * len(game_urls)
+        for index, _, game in self.stream(game_urls, extract):
+            results[index] = game
+        return results
+
+    def quit(self):
+        for driver in self.drivers:
+            driver.quit()
+        self.drivers = []
@@ -0,0 +1,140 @@
+import math
+from datetime import datetime
+import pytz
+from sortedcontainers import SortedDict, SortedList
+from nba.nba_notified import to_utc_timestamp
+from nba.nba_quotes import REFERENCE_BOOKS
+
+
+def line_rank(market, line):
+    # Orders a side's lines from worst to best for the bettor: more points on a spread, a lower total (over
+    # lines are stored positive, under lines negative). Moneyline has a single implicit line.
+    if market == 'moneyline':
+        return 0.0
+    if line is None or math.isnan(line):
+        return None
+    return line if market == 'spread' else -line
+
+
+class BestPriceIndex:
+    # Current price of every book for every game, market and side (team), kept sorted two ways: by line, each
+    # line holding its books by price, and by price over all lines. A quote update is a few O(log n) removes and
+    # inserts; best price, top-k and stale books read the sorted ends instead of scanning every book.
+
+    def __init__(self):
+        self.quotes = {}
+        self.by_line = {}
+        self.by_price = {}
+        self.consensus = {}
+        self.game_times = {}
+
+    def __len__(self):
+        return sum(len(books) for books in self.quotes.values())
+
+    def remove(self, side, book):
+        line, odds = self.quotes[side].pop(book)
+        rank = line_rank(side[1], line)
+        books = self.by_line[side][rank]
+        books.remove((-odds, book))
+        if not books:
+            del self.by_line[side][rank]
+        self.by_price[side].remove((-odds, rank, book))
+
+    def insert(self, side, book, line, odds):
+        rank = line_rank(side[1], line)
+        self.quotes[side][book] = (line, odds)
+        self.by_line[side].setdefault(rank, SortedList()).add((-odds, book))
+        self.by_price[side].add((-odds, rank, book))
+
+    def drop(self, side):
+        del self.quotes[side], self.by_line[side], self.by_price[side]
+        self.consensus.pop(side, None)
+
+    def update(self, quotes):
+        # Quotes of the games just scraped (long format) replace everything known about their sides, a book that
+        # stopped quoting a side is dropped from it
+        if quotes is None or quotes.empty:
+            return
+        columns = ['game_id', 'market', 'team', 'book', 'time', 'line', 'odds']
+        sides = {}
+        for game_id, market, team, book, time, line, odds in zip(*(quotes[column].to_numpy() for column in columns)):
+            side = (game_id, market, team)
+            self.game_times[game_id] = time
+            if book in REFERENCE_BOOKS:
+                if book == 'Consensus' and not math.isnan(line):
+                    self.consensus[side] = float(line)
+                continue
+            if math.isnan(odds) or line_rank(market, float(line)) is None:
+                continue
+            sides.setdefault(side, {})[book] = (float(line), float(odds))
+
+        # A side the scraped games no longer quote at all goes too
+        scraped = set(zip(quotes['game_id'].to_numpy(), quotes['market'].to_numpy()))
+        for side in [side for side in self.quotes if side[:2] in scraped and side not in sides]:
+            self.drop(side)
+
+        for side, books in sides.items():
+            if side not in self.quotes:
+                self.quotes[side] = {}
+                self.by_line[side] = SortedDict()
+                self.by_price[side] = SortedList()
+            current = self.quotes[side]
+            for book in [book for book in current if book not in books]:
+                self.remove(side, book)
+            for book, quote in books.items():
+                if current.get(book) == quote:
+                    continue
+                if book in current:
+                    self.remove(side, book)
+                self.insert(side, book, *quote)
+
+    def best(self, game_id, market, team, line=None):
+        # (odds, book, line) of the best price at `line` or a better line, over every line without one
+        side = (game_id, market, team)
+        if side not in self.quotes:
+            return None
+        if line is None or market == 'moneyline':
+            negative_odds, rank, book = self.by_price[side][0]
+            return -negative_odds, book, self.quotes[side][book][0]
+        best = None
+        # Lines are few per side (alternate lines), books per line many: one sorted read per line
+        for rank in self.by_line[side].irange(minimum=line_rank(market, line)):
+            negative_odds, book = self.by_line[side][rank][0]
+            if best is None or -negative_odds > best[0]:
+                best = (-negative_odds, book, self.quotes[side][book][0])
+        return best
+
+    def top_books(self, game_id, market, team, k=3, line=None):
+        # The k best priced books, at exactly `line` when given
+        side = (game_id, market, team)
+        if side not in self.quotes:
+            return []
+        if line is None or market == 'moneyline':
+            return [(-negative_odds, book, self.quotes[side][book][0])
+                    for negative_odds, _, book in self.by_price[side][:k]]
+        books = self.by_line[side].get(line_rank(market, line))
+        return [(-negative_odds, book, line) for negative_odds, book in books[:k]] if books else []
+
+    def stale_books(self, game_id, market, team):
+        # Books still quoting another line than the consensus, with how far they are off it for the bettor
+        side = (game_id, market, team)
+        consensus = self.consensus.get(side)
+        if side not in self.quotes or consensus is None or market == 'moneyline':
+            return []
+        consensus_rank = line_rank(market, consensus)
+        stale = []
+        for rank, books in self.by_line[side].items():
+            if rank == consensus_rank:
+                continue
+            stale.extend((book, self.quotes[side][book][0], -negative_odds, rank - consensus_rank)
+                         for negative_odds, book in books)
+        return stale
+
+    def evict_started(self, now=None):
+        current = to_utc_timestamp(now or datetime.now(pytz.utc))
+        started = {game_id for game_id, time in self.game_times.items() if to_utc_timestamp(time) <= current}
+        for side in [side for side in self.quotes if side[0] in started]:
+            self.drop(side)
+        for game_id in started:
+            del self.game_times[game_id]
+        return len(started)
@@ -0,0 +1,105 @@
+import re
+import numpy as np
+import pandas as pd
+from nba.nba_notified import to_utc_timestamp
+
+# Canonical long format: one row per scrape, game, team and bookmaker quote
+QUOTE_COLUMNS = ['game_id', 'scrape_ts', 'market', 'time', 'team', 'book', 'line', 'odds', 'bets_pc', 'money_pc']
+CATEGORICAL_COLUMNS = ['game_id', 'market', 'team', 'book']
+FLOAT_COLUMNS = ['line', 'odds', 'bets_pc', 'money_pc']
+# A quote of one poll is compared with the quote of the same game, team and book in the previous poll
+QUOTE_KEY = ['game_id', 'team', 'book']
+# Open and Consensus are reference columns, not books we can bet with
+REFERENCE_BOOKS = ('Open', 'Consensus')
+
+
+def game_key(game_time, teams):
+    # Stable id of a game, tipoff plus both teams, so a team with two games in the window never collides
+    slugs = [re.sub(r'[^a-z0-9]+', '-', str(team).lower()).strip('-') for team in teams]
+    return f"{to_utc_timestamp(game_time):%Y%m%dT%H%MZ}-" + '-'.join(slugs)
+
+
+def as_quote_dtypes(df):
+    # Categories do not survive a concat or merge of frames with different category sets, so this is applied
+    # after every step that builds a quotes frame
+    df = df.reindex(columns=QUOTE_COLUMNS)
+    for column in ('scrape_ts', 'time'):
+        df[column] = pd.to_datetime(df[column], utc=True)
+    return df.astype({**{column: 'category' for column in CATEGORICAL_COLUMNS},
+                      **{column: 'float32' for column in FLOAT_COLUMNS}})
+
+
+def empty_quotes():
+    return as_quote_dtypes(pd.DataFrame(columns=QUOTE_COLUMNS))
+
+
+def concat_quotes(frames):
+    frames = [frame for frame in frames if frame is not None and not frame.empty]
+    if not frames:
+        return empty_quotes()
+    return as_quote_dtypes(pd.concat(frames, ignore_index=True))
+
+
+def snapshot_bookmakers(df):
+    return [column[:-len('_odds')] for column in df.columns if column.endswith('_odds')]
+
+
+def snapshot_to_quotes(df, market, scrape_ts=None):
+    # Stack the {book}_{market}/{book}_odds column pairs of a wide snapshot into one row per quote
+    if df is None or df.empty:
+        return empty_quotes()
+    books = snapshot_bookmakers(df)
+    odds = df.reindex(columns=[f'{book}_odds' for book in books]).to_numpy(dtype=float, na_value=np.nan)
+    lines = df.reindex(columns=[f'{book}_{market}' for book in books]).to_numpy(dtype=float, na_value=np.nan)
+    rows, cols = np.nonzero(~np.isnan(odds))
+
+    quotes = pd.DataFrame({
+        'game_id': df['game_id'].to_numpy()[rows],
+        'scrape_ts': to_utc_timestamp(scrape_ts) if scrape_ts is not None else pd.NaT,
+        'market': market,
+        'time': pd.to_datetime(df['time'], utc=True).to_numpy()[rows],
+        'team': df['team'].to_numpy()[rows],
+        'book': np.asarray(books, dtype=object)[cols],
+        'line': lines[rows, cols],
+        'odds': odds[rows, cols],
+        'bets_pc': df['bets_pc'].to_numpy(dtype=float, na_value=np.nan)[rows],
+        'money_pc': df['money_pc'].to_numpy(dtype=float, na_value=np.nan)[rows],
+    })
+    return as_quote_dtypes(quotes)
+
+
+def update_quotes(previous, new):
+    # Replace the quotes of the games scraped again, keep the rest of the previous poll
+    if previous.empty:
+        return new
+    if new.empty:
+        return previous
+    return concat_quotes([previous[~previous['game_id'].isin(new['game_id'])], new])
+
+
+def quote_keys(quotes, categories):
+    # One integer per game, team and book, from the category codes over the shared categories
+    keys = np.zeros(len(quotes), dtype=np.int64)
+    for column in QUOTE_KEY:
+        codes = pd.Categorical(quotes[column], categories=categories[column]).codes
+        keys = keys * len(categories[column]) + codes
+    return keys
+
+
+def align_quotes(previous, new):
+    # Keyed join of the new quotes with the previous quote of the same game, team and book.
+    # Quotes without a previous counterpart cannot have moved and are left out.
+    if previous.empty or new.empty:
+        return pd.DataFrame()
+    categories = {column: new[column].cat.categories.union(previous[column].cat.categories) for column in QUOTE_KEY}
+    old_keys = quote_keys(previous, categories)
+    # The latest quote wins if the previous state holds the same key twice
+    latest = ~pd.Series(old_keys).duplicated(keep='last').to_numpy()
+    positions = pd.Index(old_keys[latest]).get_indexer(quote_keys(new, categories))
+    matched = positions >= 0
+
+    aligned = new[matched].rename(columns={'line': 'line_new', 'odds': 'odds_new'})
+    old_rows = np.flatnonzero(latest)[positions[matched]]
+    aligned['line_old'] = previous['line'].to_numpy()[old_rows]
+    aligned['odds_old'] = previous['odds'].to_numpy()[old_rows]
+    return aligned.reset_index(drop=True)
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+from selenium.common.exceptions import TimeoutException
+from nba.nba_metrics import METRICS
+
+# Wall time one game page may take, from its load to its last snapshot; optional tables are given up past it
+GAME_BUDGET = float(os.environ.get('NBA_GAME_BUDGET', '45'))
+# Seconds a table found missing on a game page is not waited for again on that page
+BREAKER_RESET = float(os.environ.get('NBA_BREAKER_RESET', '900'))
+
+# Resolves with the selectors still missing: none as soon as they all exist, or (until_loaded) whatever is
+# missing once the document has fully loaded, or on timeout. Driven by DOM mutations and readyState changes,
+# nothing is polled.
+READY_SCRIPT = """
+const [selectors, timeoutMs, untilLoaded, done] = arguments;
+const missing = () => selectors.filter(selector => document.querySelector(selector) === null);
+const settled = () => missing().length === 0 || (untilLoaded && document.readyState === 'complete');
+if (settled() || timeoutMs <= 0) {
+    done(missing());
+    return;
+}
+let timer = null;
+const observer = new MutationObserver(() => check());
+const finish = () => {
+    observer.disconnect();
+    document.removeEventListener('readystatechange', check);
+    clearTimeout(timer);
+    done(missing());
+};
+function check() {
+    if (settled()) finish();
+}
+observer.observe(document.documentElement, {childList: true, subtree: true});
+document.addEventListener('readystatechange', check);
+timer = setTimeout(finish, timeoutMs);
+"""
+
+
+class SelectorBreaker:
+    # Remembers the tables a page did not have, so later polls of the same game only check for them instead of
+    # waiting the full timeout again. After reset_seconds the next poll waits once more.
+
+    def __init__(self, reset_seconds=BREAKER_RESET):
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.opened = {}
+
+    def is_open(self, page, selector, now=None):
+        with self.lock:
+            opened = self.opened.get((page, selector))
+        return opened is not None and (now or time.monotonic()) - opened < self.reset_seconds
+
+    def record(self, page, selector, present, now=None):
+        now = now or time.monotonic()
+        with self.lock:
+            if present:
+                self.opened.pop((page, selector), None)
+                return
+            self.opened[(page, selector)] = now
+            # Pages of games that are long over
+            for key in [key for key, opened in self.opened.items() if now - opened > 4 * self.reset_seconds]:
+                del self.opened[key]
+
+
+SELECTOR_BREAKER = SelectorBreaker()
+
+
+class PageWaits:
+    # Waits for one page, bounded by its own timeout and by what is left of the page's budget
+
+    def __init__(self, driver, page, timeout=60, budget=GAME_BUDGET, breaker=SELECTOR_BREAKER):
+        self.driver = driver
+        self.page = page
+        self.timeout = timeout
+        self.budget = budget
+        self.deadline = time.monotonic() + budget if budget else None
+        self.breaker = breaker
+        self.over_budget = False
+
+    def remaining(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if self.deadline is None:
+            return timeout
+        return max(0.0, min(timeout, self.deadline - time.monotonic()))
+
+    def missing(self, selectors, timeout, until_loaded=False):
+        with METRICS.timed('wait', selector=','.join(selectors)):
+            # The script itself must be allowed to run past its own timeout
+            self.driver.set_script_timeout(timeout + 5)
+            return self.driver.execute_async_script(READY_SCRIPT, list(selectors), int(timeout * 1000), until_loaded)
+
+    def loaded(self):
+        return self.driver.execute_script("return document.readyState") == "complete"
+
+    def ready(self, selectors, until_loaded=True):
+        # Until the tables exist or, for pages without them (e.g. a finished game), the document has loaded
+        timeout = self.remaining()
+        missing = self.missing(selectors, timeout, until_loaded)
+        if missing and not (until_loaded and self.loaded()):
+            METRICS.increment('wait_timeouts', selector=','.join(selectors))
+            raise TimeoutException(f"{', '.join(missing)} not found on {self.page} within {timeout:.0f}s")
+        return missing
+
+    def present(self, selector, timeout=None):
+        # Optional table: waited for unless the breaker remembers this page without it or the budget is spent
+        timeout = self.timeout if timeout is None else timeout
+        allowed = self.remaining(timeout)
+        full_wait = False
+        if self.breaker.is_open(self.page, selector):
+            METRICS.increment('breaker_skips', selector=selector)
+            allowed = 0
+        elif allowed < timeout:
+            if not self.over_budget:
+                print(f"{self.page} is over its {self.budget:g}s budget, waiting {allowed:.1f}s for {selector}")
+                METRICS.increment('game_budget_exceeded')
+            self.over_budget = True
+        else:
+            full_wait = True
+        present = not self.missing([selector], allowed)
+        if not present and allowed > 0:
+            METRICS.increment('wait_timeouts', selector=selector)
+        # Only a full wait tells that the table is absent, a wait cut short by the budget does not
+        if present or full_wait:
+            self.breaker.record(self.page, selector, present)
+        return present
@@ -1,19 +1,20 @@
-import pandas as pd
 from selenium.webdriver import ActionChains
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 import time
-from selenium.common.exceptions import NoSuchElementException
-from nba.nba_helper_functions import page_has_loaded, initialize_webdriver
-from nba.nba_points import extract_total_data
-from nba.nba_spread import extract_spread_data
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+from nba.nba_helper_functions import OVERVIEW_SELECTORS, load_page
+from nba.nba_metrics import METRICS
+from nba.nba_parser import MARKETS, combine_game_results, make_soup, parse_game_urls, parse_overview_fingerprints
+from nba.nba_pool import DriverPool
+from nba.nba_readiness import PageWaits
 
 
-def scraper(BASE_URL, NBA, USERNAME, PASSWORD):
-    driver = initialize_webdriver()
+def login(driver, BASE_URL, NBA, USERNAME, PASSWORD):
     wait = WebDriverWait(driver, 20)
-    driver.get(BASE_URL + NBA)
+    load_page(driver, BASE_URL + NBA)
+    anonymous_cookies = {cookie['name'] for cookie in driver.get_cookies()}
 
     # Click the sign-in toggle button to reveal the sign-in options
     sign_in_toggle = wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, "body > header > div.page-social > span")))
@@ -49,52 +50,123 @@ def scraper(BASE_URL, NBA, USERNAME, PASSWORD):
         EC.element_to_be_clickable((By.CSS_SELECTOR, "#page-header\:menu > li:nth-child(6)")))
     ActionChains(driver).move_to_element(navigation_button).click().perform()
 
-    # Get the table that contains the games
-    wait.until(lambda d: page_has_loaded(d))
-    table = driver.find_element(By.ID, "odds-table-spread--0")
-
-    # Find all the 'td' elements that contain game links by using the class name for specificity
-    game_link_elements = table.find_elements(By.CSS_SELECTOR, "td.game-links")
-
-    game_urls = []
-
-    # Iterate through each game link 'td' to extract the navigation urls
-    for game_link_element in game_link_elements:
-        # Find the "Matchup" link within each 'td' element
-        matchup_link_element = game_link_element.find_element(By.CSS_SELECTOR,
-                                                              "ul.nav > li.nav-item.buttons > a.button.matte.rounded")
-        # Extract the 'href' attribute to get the URL
-        url = matchup_link_element.get_attribute('href')
-        # Ensure the URL is not None or empty before adding to the list
-        if url:
-            game_urls.append(url)
-
-    # Go into each game and collect spread, total and money line odds.
-    all_spread_data = []
-    all_total_data = []
-    bookmakers_spread = []
-    bookmakers_total = []
-    for url in game_urls:
-        spread_data_result = extract_spread_data(driver, url)
-        if spread_data_result:  # Check if result is not None
-            current_spread_data, bookmakers_spread = spread_data_result
-            all_spread_data.extend(current_spread_data)
-
-        total_data_result = extract_total_data(driver, url)
-        if total_data_result:  # Check if result is not None
-            current_total_data, bookmakers_total = total_data_result
-            all_total_data.extend(current_total_data)
-
-    if all_spread_data:  # Checks if list is not empty
-        nba_spread_df = pd.DataFrame(all_spread_data)
-    else:
-        nba_spread_df = pd.DataFrame()  # Create an empty DataFrame if no data
-
-    if all_total_data:  # Checks if list is not empty
-        nba_total_df = pd.DataFrame(all_total_data)
-    else:
-        nba_total_df = pd.DataFrame()
-
-    driver.quit()
-
-    return nba_spread_df, nba_total_df, bookmakers_spread, bookmakers_total
+    # Names of the cookies set by signing in
+    return {cookie['name'] for cookie in driver.get_cookies()} - anonymous_cookies
+
+
+def collect_overview(driver):
+    # Matchup links and a fingerprint of every game's overview lines, from one page source snapshot
+    # The odds table is required, the overview is useless without it
+    PageWaits(driver, driver.current_url, timeout=20, budget=None).ready(OVERVIEW_SELECTORS, until_loaded=False)
+    soup = make_soup(driver.page_source)
+    game_urls = parse_game_urls(soup, base_url=driver.current_url)
+    fingerprints = parse_overview_fingerprints(soup, base_url=driver.current_url)
+    # Games the fingerprinting could not delimit get None and are always deep scraped
+    return game_urls, {url: fingerprints.get(url) for url in game_urls}
+
+
+class ScraperSession:
+    # A logged-in pool of drivers that stays warm between polling cycles
+    # Errors after which the caller should restart the session
+    errors = (WebDriverException,)
+
+    def __init__(self, BASE_URL, NBA, USERNAME, PASSWORD, workers=1, lean=False):
+        self.base_url = BASE_URL
+        self.nba = NBA
+        self.username = USERNAME
+        self.password = PASSWORD
+        self.workers = workers
+        self.lean = lean
+        self.pool = None
+        self.auth_cookies = set()
+        self.on_fresh_overview = False
+        self.restarts = 0
+        self.logins = 0
+
+    def start(self):
+        self.pool = DriverPool(self.workers, self.lean).start()
+        self.login()
+        return self
+
+    def login(self):
+        driver = self.pool.drivers[0]
+        # Cookies set by the sign-in are the ones that tell whether the session is still valid
+        with METRICS.timed('login'):
+            self.auth_cookies = login(driver, self.base_url, self.nba, self.username, self.password)
+        self.pool.share_session(driver, self.base_url)
+        self.on_fresh_overview = True
+        self.logins += 1
+
+    def is_alive(self):
+        if self.pool is None or not self.pool.drivers:
+            return False
+        return all(driver.is_alive() for driver in self.pool.drivers)
+
+    def is_logged_in(self):
+        cookies = {cookie['name'] for cookie in self.pool.drivers[0].get_cookies()}
+        return self.auth_cookies <= cookies
+
+    def restart(self):
+        print("Restarting the webdriver pool...")
+        self.close()
+        self.restarts += 1
+        self.start()
+
+    def ensure_ready(self):
+        # Only pay for a restart or a new login when the session actually broke
+        if self.pool is None or not self.pool.drivers:
+            self.restart()
+            return
+        # A browser that died between polls is replaced on its own, with the session cookies put back
+        for driver in self.pool.drivers:
+            if not driver.is_alive():
+                print(f"Webdriver {driver.worker} died, restarting it")
+                driver.restarts += 1
+                METRICS.increment('driver_crash_restarts', worker=driver.worker)
+                driver.replace()
+        if not self.is_logged_in():
+            print("Session expired, logging in again...")
+            self.login()
+
+    def read_overview(self):
+        self.ensure_ready()
+        driver = self.pool.drivers[0]
+        # Right after logging in the first driver already sits on the odds page
+        if not self.on_fresh_overview:
+            load_page(driver, self.base_url + self.nba)
+        self.on_fresh_overview = False
+        return collect_overview(driver)
+
+    def list_games(self):
+        return self.read_overview()[0]
+
+    @property
+    def failed_urls(self):
+        return self.pool.failed_urls
+
+    def scrape_games(self, game_urls):
+        # Go into each game once and collect spread, total and money line odds.
+        return self.pool.scrape(game_urls)
+
+    def stream_games(self, game_urls):
+        # (url, game) pairs as each game is scraped, failed games come out as None and in failed_urls
+        for _, url, game in self.pool.stream(game_urls):
+            yield url, game
+
+    def scrape(self):
+        return combine_game_results(self.scrape_games(self.list_games()))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.quit()
+            self.pool = None
+
+
+def scraper(BASE_URL, NBA, USERNAME, PASSWORD, workers=1, lean=False):
+    # Start the pool once, log in with the first driver and share its session with the others
+    session = ScraperSession(BASE_URL, NBA, USERNAME, PASSWORD, workers, lean)
+    try:
+        session.start()
+        return session.scrape()
+    finally:
+        session.close()
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pandas as pd
+from nba.nba_quotes import REFERENCE_BOOKS
+
+# A steam move: at least STEAM_BOOKS books move a line the same way within STEAM_MINUTES
+STEAM_BOOKS = int(os.environ.get('NBA_STEAM_BOOKS', '5'))
+STEAM_MINUTES = float(os.environ.get('NBA_STEAM_MINUTES', '10'))
+STEAM_MARKETS = ('spread', 'total')
+# Books named as still at the old number in an alert
+MAX_LAGGARDS = 5
+
+
+def detect_steam(tracker, minutes=STEAM_MINUTES, min_books=STEAM_BOOKS, now=None, game_ids=None):
+    # Sides whose line at least min_books books made worse for the bettor over the last `minutes` (the money is
+    # on that side), with the books that have not moved yet. Spread and total only, over the tracker's buffers.
+    moves = tracker.movement_within(minutes, now)
+    keep = moves['market'].isin(STEAM_MARKETS) & ~moves['book'].isin(REFERENCE_BOOKS)
+    if game_ids is not None:
+        keep &= moves['game_id'].isin(game_ids)
+    moves = moves[keep].reset_index(drop=True)
+    if moves.empty:
+        return []
+
+    # Worse for the bettor is fewer points on a spread and, with under lines stored negative, a higher signed total
+    lines = moves['line'].to_numpy(dtype=float)
+    line_move = moves['line_move'].to_numpy(dtype=float)
+    against = np.where(moves['market'].to_numpy() == 'spread', line_move, -line_move)
+    codes, sides = pd.factorize(pd.MultiIndex.from_frame(moves[['market', 'game_id', 'team']]))
+    with np.errstate(invalid='ignore'):
+        moved = against < 0
+        unmoved = line_move == 0
+    moved_books = np.bincount(codes, weights=moved, minlength=len(sides))
+    steamed = np.flatnonzero(moved_books >= min_books)
+
+    steams = []
+    for side in steamed:
+        rows = codes == side
+        mover_rows = np.flatnonzero(rows & moved)
+        # Books still at the pre-window number, the best line for the bettor first, then the best price
+        laggards = moves.iloc[np.flatnonzero(rows & unmoved)]
+        laggards = laggards.assign(rank=np.where(laggards['market'] == 'spread', laggards['line'], -laggards['line']))
+        laggards = laggards.sort_values(['rank', 'odds'], ascending=False, kind='stable')
+        market, game_id, team = sides[side]
+        steams.append({
+            'market': market,
+            'game_id': game_id,
+            'team': team,
+            'time': moves['time'].iloc[mover_rows[0]],
+            'books_moved': len(mover_rows),
+            'moved_books': list(moves['book'].iloc[mover_rows]),
+            'line_from': float(np.median(lines[mover_rows] - line_move[mover_rows])),
+            'line_to': float(np.median(lines[mover_rows])),
+            'laggards': [(book, float(line), round(float(odds), 2))
+                         for book, line, odds in zip(laggards['book'], laggards['line'], laggards['odds'])],
+        })
+    return steams
+
+
+def steam_messages(steams, notified_movements, minutes=STEAM_MINUTES):
+    all_messages = []
+    for steam in steams:
+        identifier = f"{steam['game_id']}_{steam['team']}_{steam['market']}_{steam['line_to']}_steam"
+        if identifier in notified_movements:
+            continue
+        laggards = ', '.join(f"{book} ({line}, {odds})" for book, line, odds in steam['laggards'][:MAX_LAGGARDS])
+        message = (f"<b>Steam Move Detected for {steam['team']}</b>\n"
+                   f"- <b>{steam['books_moved']}</b> books moved the {steam['market']} from {steam['line_from']} "
+                   f"to {steam['line_to']} in the last {minutes:g} minutes\n"
+                   + (f"- <b>Not moved yet</b>: {laggards}\n" if laggards else ''))
+        all_messages.append(message)
+        notified_movements.add(identifier, steam['time'])
+    return '\n\n'.join(all_messages)
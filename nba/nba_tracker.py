@@ -0,0 +1,203 @@
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytz
+from nba.nba_history import HISTORY_DIR, read_quotes_since
+from nba.nba_notified import to_utc_timestamp
+
+TRACKER_FILE = 'movement_tracker.npz'
+# Quotes kept per market, game, team and book: at one poll a minute, the last half hour
+TRACKER_DEPTH = 32
+TRACKER_KEY = ['market', 'game_id', 'team', 'book']
+# Empty ring slots and quotes that never moved
+NO_TIME = np.iinfo(np.int64).min
+
+
+def nanoseconds(value):
+    return to_utc_timestamp(value).value
+
+
+class MovementTracker:
+    # The last `depth` (scrape time, line, odds) quotes of every market, game, team and book, in preallocated
+    # ring buffers, one row per key. Besides the ring every row keeps its opening quote and the time its line
+    # (moneyline: price) last moved, so every query is a fixed amount of work per key whatever the history length.
+
+    def __init__(self, depth=TRACKER_DEPTH, capacity=1024, path=TRACKER_FILE):
+        self.depth = depth
+        self.path = path
+        self.rows = {}
+        self.keys = []
+        self.free = []
+        self.capacity = 0
+        self.ts = np.empty((0, depth), dtype=np.int64)
+        self.line = np.empty((0, depth), dtype=np.float32)
+        self.odds = np.empty((0, depth), dtype=np.float32)
+        self.head = np.empty(0, dtype=np.int32)
+        self.count = np.empty(0, dtype=np.int32)
+        self.open_ts = np.empty(0, dtype=np.int64)
+        self.open_line = np.empty(0, dtype=np.float32)
+        self.open_odds = np.empty(0, dtype=np.float32)
+        self.moved_ts = np.empty(0, dtype=np.int64)
+        self.game_time = np.empty(0, dtype=np.int64)
+        self.grow(capacity)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def grow(self, capacity):
+        # Arrays double when full, rows keep their index
+        extra = capacity - self.capacity
+        if extra <= 0:
+            return
+        self.ts = np.vstack([self.ts, np.full((extra, self.depth), NO_TIME, dtype=np.int64)])
+        self.line = np.vstack([self.line, np.full((extra, self.depth), np.nan, dtype=np.float32)])
+        self.odds = np.vstack([self.odds, np.full((extra, self.depth), np.nan, dtype=np.float32)])
+        for name, fill in (('head', 0), ('count', 0), ('open_ts', NO_TIME), ('open_line', np.nan),
+                           ('open_odds', np.nan), ('moved_ts', NO_TIME), ('game_time', NO_TIME)):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.full(extra, fill, dtype=array.dtype)]))
+        self.keys.extend([None] * extra)
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def row_of(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            if not self.free:
+                self.grow(max(2 * self.capacity, 64))
+            row = self.free.pop()
+            self.rows[key] = row
+            self.keys[row] = key
+        return row
+
+    def update(self, quotes):
+        # Push one poll's long quotes (see nba_quotes); a key is expected once per call
+        if quotes is None or quotes.empty:
+            return
+        keys = zip(*(quotes[column].astype(object).to_numpy() for column in TRACKER_KEY))
+        rows = np.fromiter((self.row_of(key) for key in keys), dtype=np.int64, count=len(quotes))
+        ts = quotes['scrape_ts'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        line = quotes['line'].to_numpy(dtype=np.float32, na_value=np.nan)
+        odds = quotes['odds'].to_numpy(dtype=np.float32, na_value=np.nan)
+        moneyline = (quotes['market'].astype(object) == 'moneyline').to_numpy()
+
+        seen = self.count[rows] > 0
+        last = (self.head[rows] - 1) % self.depth
+        # Moneyline has no line, its price is what moves
+        value = np.where(moneyline, odds, line)
+        last_value = np.where(moneyline, self.odds[rows, last], self.line[rows, last])
+        moved = seen & ~np.isnan(value) & ~np.isnan(last_value) & (value != last_value)
+        self.moved_ts[rows[moved]] = ts[moved]
+
+        new = rows[~seen]
+        self.open_ts[new] = ts[~seen]
+        self.open_line[new] = line[~seen]
+        self.open_odds[new] = odds[~seen]
+        self.game_time[rows] = quotes['time'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+
+        position = self.head[rows]
+        self.ts[rows, position] = ts
+        self.line[rows, position] = line
+        self.odds[rows, position] = odds
+        self.head[rows] = (position + 1) % self.depth
+        self.count[rows] = np.minimum(self.count[rows] + 1, self.depth)
+
+    def active_rows(self):
+        return np.flatnonzero(self.count > 0)
+
+    def key_frame(self, rows):
+        return pd.DataFrame([self.keys[row] for row in rows], columns=TRACKER_KEY).assign(
+            time=pd.to_datetime(self.game_time[rows], utc=True))
+
+    def latest(self, rows):
+        position = (self.head[rows] - 1) % self.depth
+        return self.line[rows, position], self.odds[rows, position]
+
+    def movement_since_open(self):
+        rows = self.active_rows()
+        line, odds = self.latest(rows)
+        return self.key_frame(rows).assign(line=line, odds=odds, line_move=line - self.open_line[rows],
+                                           odds_move=odds - self.open_odds[rows])
+
+    def movement_within(self, minutes, now=None):
+        # Latest quote against the last one at least `minutes` old; keys younger than that are measured from
+        # their oldest buffered quote
+        rows = self.active_rows()
+        cutoff = nanoseconds(now or datetime.now(pytz.utc)) - int(minutes * 60e9)
+        ts = self.ts[rows]
+        filled = ts != NO_TIME
+        before = np.where(filled & (ts <= cutoff), ts, NO_TIME)
+        reference = np.where(before.max(axis=1) != NO_TIME, before.argmax(axis=1),
+                             np.where(filled, ts, np.iinfo(np.int64).max).argmin(axis=1))
+        line, odds = self.latest(rows)
+        return self.key_frame(rows).assign(line=line, odds=odds,
+                                           line_move=line - self.line[rows, reference],
+                                           odds_move=odds - self.odds[rows, reference])
+
+    def unmoved(self, since=None):
+        # Keys whose line (moneyline: price) has not moved since `since`, or ever when since is None
+        rows = self.active_rows()
+        moved_ts = self.moved_ts[rows]
+        still = moved_ts == NO_TIME if since is None else moved_ts < nanoseconds(since)
+        rows = rows[still]
+        line, odds = self.latest(rows)
+        return self.key_frame(rows).assign(line=line, odds=odds)
+
+    def evict_started(self, now=None):
+        # Rows of games that tipped off go back to the free list
+        current = nanoseconds(now or datetime.now(pytz.utc))
+        rows = np.flatnonzero((self.count > 0) & (self.game_time <= current))
+        for row in rows:
+            del self.rows[self.keys[row]]
+            self.keys[row] = None
+            self.free.append(row)
+        self.count[rows] = 0
+        self.head[rows] = 0
+        self.ts[rows] = NO_TIME
+        self.line[rows] = np.nan
+        self.odds[rows] = np.nan
+        self.moved_ts[rows] = NO_TIME
+        return len(rows)
+
+    def save(self):
+        # Only the rows in use, rotated so their oldest quote comes first
+        rows = self.active_rows()
+        order = (self.head[rows, None] - self.count[rows, None] + np.arange(self.depth)) % self.depth
+        temp_path = f'{self.path}.tmp.npz'
+        np.savez_compressed(
+            temp_path, depth=self.depth, keys=np.array([self.keys[row] for row in rows], dtype=str).reshape(-1, 4),
+            ts=np.take_along_axis(self.ts[rows], order, axis=1),
+            line=np.take_along_axis(self.line[rows], order, axis=1),
+            odds=np.take_along_axis(self.odds[rows], order, axis=1),
+            **{name: getattr(self, name)[rows] for name in ('count', 'open_ts', 'open_line', 'open_odds', 'moved_ts',
+                                                            'game_time')})
+        os.replace(temp_path, self.path)
+
+    @classmethod
+    def load(cls, path=TRACKER_FILE, now=None):
+        try:
+            saved = dict(np.load(path))
+        except (OSError, ValueError):
+            return cls(path=path)
+        size = len(saved['keys'])
+        tracker = cls(int(saved['depth']), max(size, 1024), path)
+        tracker.rows = {tuple(key): row for row, key in enumerate(saved['keys'].tolist())}
+        for key, row in tracker.rows.items():
+            tracker.keys[row] = key
+        tracker.free = list(range(tracker.capacity - 1, size - 1, -1))
+        for name in ('ts', 'line', 'odds', 'count', 'open_ts', 'open_line', 'open_odds', 'moved_ts', 'game_time'):
+            getattr(tracker, name)[:size] = saved[name]
+        # The saved buffers start at their oldest quote
+        tracker.head[:size] = tracker.count[:size] % tracker.depth
+        tracker.evict_started(now)
+        return tracker
+
+    @classmethod
+    def from_history(cls, since, markets, root=HISTORY_DIR):
+        # A cron run keeps no tracker between runs, the scrapes stored in the odds history are replayed instead
+        tracker = cls(path=None)
+        for market in markets:
+            for quotes in read_quotes_since(market, since, root):
+                tracker.update(quotes)
+        return tracker
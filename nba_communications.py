@@ -1,48 +1,266 @@
+import json
 import os
+import threading
+import time
 from telegram import Bot
-from telegram.error import BadRequest, RetryAfter
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 import asyncio
-import telegram
+from nba.nba_metrics import METRICS
 
+MAX_LENGTH = 4096
+MAX_RETRIES = 3
+# Telegram allows about 30 messages per second per bot, one per second per chat and 20 per minute per group
+GLOBAL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+# Alerts are joined with a blank line, split_message packs them into parts along it
+ALERT_SEPARATOR = '\n\n'
+# Alerts some chats did not get, per chat id; messages.txt holds the ones no chat got yet
+UNSENT_FILE = 'unsent_messages.json'
 
-async def send_telegram_message(bot_token, chat_id, message, parse_mode='HTML'):
-    if not message.strip():
-        return
-    bot = Bot(token=bot_token)
-    try:
-        print("Attempting to send message...")
-        await bot.send_message(chat_id=chat_id, text=message, parse_mode='HTML')
-        print("Message sent successfully!")
-        await asyncio.sleep(10)
-    except BadRequest as e:
-        print(f"Failed to send message due to BadRequest: {e}")
-    except RetryAfter as e:
-        wait_time = e.retry_after
-        print(f"Hit rate limit, retrying after {wait_time} seconds...")
-        await asyncio.sleep(wait_time)
-        await send_telegram_message(bot_token, chat_id, message, parse_mode)  # Retry sending the message
-        await asyncio.sleep(10)
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-
-
-async def send_long_message(bot_token, chat_id, long_message, parse_mode='HTML', delay=10):
-    MAX_LENGTH = 4096
-    parts = [long_message[i:i+MAX_LENGTH] for i in range(0, len(long_message), MAX_LENGTH)]
-    print(f'Number of messages to send: {len(parts)}')
-    total_wait_time = 0
-    for part in parts:
+
+class TokenBucket:
+    # Refills `rate` tokens per second up to `capacity`, acquire() waits for a token
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+    def pause(self, seconds):
+        # Telegram asked us to back off, the next token is only available after that long
+        self.refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+def split_message(message, max_length=MAX_LENGTH, separator=ALERT_SEPARATOR):
+    # Pack whole alerts into parts, only an alert longer than max_length is cut
+    parts = []
+    current = ''
+    for block in message.split(separator):
+        if not block.strip():
+            continue
+        for piece in [block[i:i + max_length] for i in range(0, len(block), max_length)]:
+            candidate = f'{current}{separator}{piece}' if current else piece
+            if len(candidate) <= max_length:
+                current = candidate
+            else:
+                parts.append(current)
+                current = piece
+    if current:
+        parts.append(current)
+    return parts
+
+
+def parse_chat_ids(chat_ids):
+    # TELEGRAM_CHAT_ID may hold several comma separated chat ids
+    if chat_ids is None:
+        return []
+    if isinstance(chat_ids, (list, tuple, set)):
+        return list(chat_ids)
+    return [chat_id.strip() for chat_id in str(chat_ids).split(',') if chat_id.strip()]
+
+
+class TelegramOutbox:
+    # One Bot and HTTP connection pool shared by every message, rate limited per chat and globally
+
+    def __init__(self, bot_token, parse_mode='HTML', max_retries=MAX_RETRIES, bot=None):
+        self.bot = bot or Bot(token=bot_token, request=HTTPXRequest(connection_pool_size=8))
+        self.parse_mode = parse_mode
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.chat_locks = {}
+        self.total_wait_time = 0
+        self.sent = 0
+        self.failed = 0
+        # Alerts that could not be sent (not the ones Telegram rejected) per chat, for the caller to try again later
+        self.unsent = {}
+
+    async def __aenter__(self):
+        await self.bot.initialize()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.bot.shutdown()
+
+    def chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            # Group and channel ids are negative
+            rate = GROUP_CHAT_RATE if str(chat_id).startswith('-') else PRIVATE_CHAT_RATE
+            self.chat_buckets[chat_id] = TokenBucket(rate)
+        return self.chat_buckets[chat_id]
+
+    async def send(self, chat_id, text):
+        bucket = self.chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                with METRICS.timed('telegram_send'):
+                    await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=self.parse_mode)
+                self.sent += 1
+                return True
+            except RetryAfter as e:
+                wait_time = float(getattr(e.retry_after, 'total_seconds', lambda: e.retry_after)())
+                print(f"Hit rate limit, retrying after {wait_time} seconds...")
+                self.total_wait_time += wait_time
+                bucket.pause(wait_time)
+            except BadRequest as e:
+                alerts = [alert for alert in text.split(ALERT_SEPARATOR) if alert.strip()]
+                if len(alerts) > 1:
+                    # A packed part: one bad alert must not take the alerts packed with it down
+                    print(f"Part rejected due to BadRequest ({e}), sending its {len(alerts)} alerts one by one")
+                    results = [await self.send(chat_id, alert) for alert in alerts]
+                    return all(results)
+                # The message itself is rejected, sending it again will not help
+                print(f"Failed to send message due to BadRequest: {e}\n{text}")
+                self.failed += 1
+                return False
+            except NetworkError as e:
+                wait_time = 2 ** attempt
+                print(f"Network error ({e}), retrying in {wait_time} seconds...")
+                self.total_wait_time += wait_time
+                await asyncio.sleep(wait_time)
+            except Forbidden as e:
+                # The user blocked the bot or removed it from the chat, no retry will get through
+                print(f"Failed to send message to chat {chat_id}: {e}")
+                self.failed += 1
+                return False
+            except TelegramError as e:
+                print(f"Failed to send message to chat {chat_id} ({type(e).__name__}: {e}), keeping it for later")
+                break
+        self.failed += 1
+        self.keep_unsent(chat_id, text)
+        return False
+
+    def keep_unsent(self, chat_id, text):
+        chat_unsent = self.unsent.setdefault(str(chat_id), [])
+        if text not in chat_unsent:
+            chat_unsent.append(text)
+
+    async def send_parts(self, chat_id, parts):
+        # Batches for the same chat go out one after the other so their parts never interleave
+        lock = self.chat_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            for part in parts:
+                await self.send(chat_id, part)
+
+    async def send_long(self, chat_ids, long_message):
+        parts = split_message(long_message)
+        if not parts:
+            return
+        print(f'Number of messages to send: {len(parts)} to {len(parse_chat_ids(chat_ids))} chats')
+        await asyncio.gather(*(self.send_parts(chat_id, parts) for chat_id in parse_chat_ids(chat_ids)))
+
+
+class BackgroundOutbox:
+    # Runs an outbox on its own event loop thread, so synchronous code can hand over alerts without waiting
+
+    def __init__(self, bot_token, chat_ids, bot=None):
+        self.chat_ids = parse_chat_ids(chat_ids)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.outbox = self.run(self.create_outbox(bot_token, bot)).result()
+        self.pending = set()
+        # Exceptions of batches and of the shutdown, reported by close() instead of raised
+        self.errors = []
+
+    async def create_outbox(self, bot_token, bot):
+        # Locks and buckets belong to the loop they are created on
+        return await TelegramOutbox(bot_token, bot=bot).__aenter__()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def submit(self, message):
+        future = self.run(self.send_batch(message))
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future
+
+    async def send_batch(self, message):
+        try:
+            await self.outbox.send_long(self.chat_ids, message)
+        except Exception as e:
+            # A batch that raised may have reached no chat at all, it is kept for every chat
+            print(f"Sending alerts failed: {e!r}")
+            self.errors.append(e)
+            for chat_id in self.chat_ids:
+                self.outbox.keep_unsent(chat_id, message)
+
+    def take_unsent(self):
+        # The alerts that failed so far per chat, each handed out once
+        unsent, self.outbox.unsent = self.outbox.unsent, {}
+        return unsent
+
+    def save_unsent(self, path=UNSENT_FILE):
+        add_unsent(self.take_unsent(), path)
+
+    def close(self):
+        # Never raises, the caller still has to save what was not sent
+        for future in list(self.pending):
+            future.result()
         try:
-            print('Sending message...')
-            await send_telegram_message(bot_token, chat_id, part, parse_mode='HTML')
-            await asyncio.sleep(delay)  # Respect Telegram's rate limits
-        except telegram.error.RetryAfter as e:
-            print(f"Rate limit exceeded, waiting for {e.retry_after} seconds.")
-            wait_time = e.retry_after + 1
-            total_wait_time += wait_time
-            await asyncio.sleep(e.retry_after + 1)  # Wait a bit longer than recommended
-            await send_telegram_message(bot_token, chat_id, part, parse_mode)  # Wait a bit between messages to avoid hitting rate limits
-    return total_wait_time
+            self.run(self.outbox.__aexit__(None, None, None)).result()
+        except Exception as e:
+            print(f"Failed to shut the Telegram bot down: {e!r}")
+            self.errors.append(e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def load_unsent(path=UNSENT_FILE):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_unsent(unsent, path=UNSENT_FILE):
+    unsent = {chat_id: alerts for chat_id, alerts in unsent.items() if alerts}
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(unsent, file, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def add_unsent(unsent, path=UNSENT_FILE):
+    if not any(unsent.values()):
+        return
+    merged = load_unsent(path)
+    for chat_id, alerts in unsent.items():
+        chat_unsent = merged.setdefault(chat_id, [])
+        chat_unsent.extend(alert for alert in alerts if alert not in chat_unsent)
+    write_unsent(merged, path)
+
+
+async def send_long_message(bot_token, chat_id, long_message, parse_mode='HTML', unsent=None):
+    # Sends long_message to every chat and the earlier unsent alerts to their own chat, returns the alerts that
+    # could not be sent per chat
+    async with TelegramOutbox(bot_token, parse_mode) as outbox:
+        await asyncio.gather(outbox.send_long(chat_id, long_message),
+                             *(outbox.send_long(chat, ALERT_SEPARATOR.join(alerts))
+                               for chat, alerts in (unsent or {}).items()))
+    return outbox.unsent
 
 
 async def main():
@@ -50,18 +268,21 @@ async def main():
     BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
     CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
 
+    message_to_send = ''
     if os.path.exists(messages_file) and os.path.getsize(messages_file) > 0:
         with open(messages_file, 'r') as file:
             message_to_send = file.read()
-            if message_to_send.strip():
-                # Use the asynchronous function for sending long messages
-                await send_long_message(BOT_TOKEN, CHAT_ID, message_to_send)
-                # Clear the file content after sending the message
-                open(messages_file, 'w').close()
-            else:
-                print("The message file is empty, no message sent.")
+    unsent = load_unsent()
+    if message_to_send.strip() or unsent:
+        # Use the asynchronous function for sending long messages
+        unsent = await send_long_message(BOT_TOKEN, CHAT_ID, message_to_send, unsent=unsent)
+        # Clear the file content after sending the message, what could not be sent is kept per chat for the next run
+        with open(messages_file, 'w'):
+            pass
+        write_unsent(unsent)
     else:
         print(f"{messages_file} does not exist or is empty, no message to send.")
+    METRICS.flush_cycle(prometheus_file='nba_telegram.prom', mode='telegram')
 
 if __name__ == "__main__":
     asyncio.run(main())
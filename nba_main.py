@@ -1,6 +1,20 @@
-import pandas as pd
+import time
+STARTED = time.perf_counter()
+import argparse
+import traceback
+from datetime import datetime, timedelta
+import pytz
+import schedule
 from nba.nba_helper_functions import remove_past_events, detect_and_accumulate
-from nba.nba_scraper import scraper
+from nba.nba_metrics import METRICS
+from nba.nba_history import HistoryWriter, read_latest_quotes
+from nba.nba_notified import NotifiedStore
+from nba.nba_parser import MARKETS, combine_game_results
+from nba.nba_polling import TipoffScheduler, OverviewTracker
+from nba.nba_prices import BestPriceIndex
+from nba.nba_quotes import align_quotes, concat_quotes, update_quotes
+from nba.nba_steam import STEAM_MARKETS, STEAM_MINUTES, detect_steam, steam_messages
+from nba.nba_tracker import MovementTracker
 import os
 
 # Access environment variables
@@ -10,67 +24,301 @@ PASSWORD = os.environ['VI_PASSWORD']
 BASE_URL = 'https://www.vegasinsider.com/'
 NBA = 'nba/odds/las-vegas/'
 
-# Define filenames for saving dataframes
-SPREAD_DF_FILE = 'nba_spread_df.csv'
-TOTAL_DF_FILE = 'nba_total_df.csv'
+# Number of headless browsers scraping game pages in parallel
+SCRAPER_WORKERS = int(os.environ.get('NBA_SCRAPER_WORKERS', '4'))
+# 'browser' scrapes every page with Chromium, 'http' fetches the server-rendered pages without it
+FETCH_BACKEND = os.environ.get('NBA_FETCH_BACKEND', 'browser')
+# Lean browser profile: eager page loads, no images, fonts, ads or trackers
+LEAN_BROWSER = os.environ.get('NBA_LEAN_BROWSER', '0') == '1'
+# Seconds between polls in daemon mode
+POLL_INTERVAL = int(os.environ.get('NBA_POLL_INTERVAL', '30'))
+# Seconds after which a game is deep scraped again even if its overview lines did not move
+TRENDS_REFRESH = int(os.environ.get('NBA_TRENDS_REFRESH', '900'))
+# Maximum number of game pages per poll in daemon mode, 0 for no limit
+GAMES_PER_POLL = int(os.environ.get('NBA_GAMES_PER_POLL', '0')) or None
+
+# Everything above, measured for the startup breakdown
+IMPORT_SECONDS = time.perf_counter() - STARTED
+
+# Define filenames for saving messages
 MESSAGES_FILE = 'messages.txt'
 
 
-def scheduled_job():
-    # Load existing dataframes if they exist
-    try:
-        nba_spread_df = pd.read_csv(SPREAD_DF_FILE)
-        nba_total_df = pd.read_csv(TOTAL_DF_FILE)
-    except FileNotFoundError:
-        print("Files not found, creating new dataframes...")
-        nba_spread_df, nba_total_df, _, _ = scraper(BASE_URL, NBA, USERNAME, PASSWORD)
-        nba_spread_df.to_csv(SPREAD_DF_FILE, index=False)
-        nba_total_df.to_csv(TOTAL_DF_FILE, index=False)
-        return
-
-    # Call the scraper to collect the latest data
-    new_spread_df, new_total_df, bookmakers_spread, bookmakers_total = scraper(BASE_URL, NBA, USERNAME, PASSWORD)
-    #  if Open or Consensus in bookmakers_spread and bookmakers_total, drop them
-    if 'Open' in bookmakers_spread:
-        bookmakers_spread.remove('Open')
-    if 'Consensus' in bookmakers_spread:
-        bookmakers_spread.remove('Consensus')
-    if 'Open' in bookmakers_total:
-        bookmakers_total.remove('Open')
-    if 'Consensus' in bookmakers_total:
-        bookmakers_total.remove('Consensus')
+def detect_market_messages(previous, new, bet_type, notified_movements, prices=None):
+    with METRICS.timed('merge', market=bet_type):
+        aligned = align_quotes(previous, new)
+    with METRICS.timed('detect', market=bet_type):
+        return detect_and_accumulate(aligned, bet_type, notified_movements, prices)
 
+
+def detect_messages(previous, new, notified_movements, prices=None):
     all_messages = []
-    # Merge the new data with the existing dataframes
-    if not nba_spread_df.empty:
-        updated_spread_df = pd.merge(nba_spread_df, new_spread_df, on='team', how='outer', suffixes=('_old', '_new'))
-        spread_messages = detect_and_accumulate(updated_spread_df, 'spread', bookmakers_spread)
-        all_messages.append(spread_messages)
+    # Align the new quotes with the previous poll, market by market
+    for market in MARKETS:
+        if not previous[market].empty and not new[market].empty:
+            all_messages.append(detect_market_messages(previous[market], new[market], market, notified_movements,
+                                                       prices))
+
+    # Join the messages with two newlines for separation
+    return '\n\n'.join(message for message in all_messages if message)
 
-    if not nba_total_df.empty:
-        updated_total_df = pd.merge(nba_total_df, new_total_df, on='team', how='outer', suffixes=('_old', '_new'))
-        points_messages = detect_and_accumulate(updated_total_df, 'total', bookmakers_total)
-        all_messages.append(points_messages)
 
-    # Remove past events from updated dataframes
-    new_spread_df = remove_past_events(new_spread_df)
-    new_total_df = remove_past_events(new_total_df)
+def previous_snapshots(new):
+    # Latest stored quotes of the games just scraped, which may come from earlier polls
+    return {market: remove_past_events(read_latest_quotes(market, game_ids=list(new[market]['game_id'].unique())))
+            for market in MARKETS}
 
-    # Update the initial dataframes with the new data for the next iteration
-    nba_spread_df = new_spread_df
-    nba_total_df = new_total_df
 
-    # Join the messages with two newlines for separation
-    message_to_send = '\n\n'.join(all_messages)
-    # save messages for sending
-    with open(MESSAGES_FILE, 'w') as file:
-        file.write(message_to_send)
+def stream_messages(session, game_urls, scrape_ts, previous_quotes, notified_movements, prices):
+    # Merge and detect every game as soon as it is scraped, its alerts do not wait for the rest of the slate.
+    # previous_quotes(new) gives the quotes the game's new quotes are compared with.
+    for url, game in session.stream_games(game_urls):
+        new = combine_game_results([game], scrape_ts)
+        # The alerts quote the best price across books, so the index holds the game's new quotes first
+        for market in MARKETS:
+            prices.update(new[market])
+        message = detect_messages(previous_quotes(new), new, notified_movements, prices)
+        if message:
+            # From the start of the poll to the alert being handed to the sender
+            METRICS.record('alert', (datetime.now(pytz.utc) - scrape_ts).total_seconds(), game=url)
+        yield url, game, new, message
+
+
+def in_url_order(games, urls):
+    # Games stream in completion order, the history gets them in overview order so a poll's rows do not depend on
+    # worker timing
+    return [games[url] for url in urls if url in games]
+
+
+def game_ids(new):
+    return set().union(*(new[market]['game_id'].astype(object) for market in MARKETS))
+
+
+def steam_message(tracker, new, scrape_ts, notified_movements):
+    tracker.update(concat_quotes(new.values()))
+    # Moves of many books within minutes only show over the tracker's window, not between two polls
+    return steam_messages(detect_steam(tracker, now=scrape_ts, game_ids=game_ids(new)), notified_movements)
+
+
+def open_outbox():
+    # Imported here, the Telegram client is only needed when alerts are sent from this process
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        return None
+    from nba_communications import BackgroundOutbox
+    return BackgroundOutbox(bot_token, os.environ.get('TELEGRAM_CHAT_ID'))
+
+
+def save_messages(messages, path=MESSAGES_FILE):
+    # Appended, the send step of the workflow sends the file and clears it
+    with open(path, 'a') as file:
+        file.write(''.join(f'{message}\n\n' for message in messages))
+
+
+def make_session(backend=FETCH_BACKEND, lean=LEAN_BROWSER):
+    if backend == 'http':
+        # Imported here, httpx is only needed by the HTTP backend
+        from nba.nba_http import HttpSession
+        return HttpSession(BASE_URL, NBA, USERNAME, PASSWORD, lean=lean)
+    # Imported here, selenium's webdriver is only needed by the browser backend
+    from nba.nba_scraper import ScraperSession
+    return ScraperSession(BASE_URL, NBA, USERNAME, PASSWORD, SCRAPER_WORKERS, lean)
 
-    # At the end, save the updated dataframes
-    nba_spread_df.to_csv(SPREAD_DF_FILE, index=False)
-    nba_total_df.to_csv(TOTAL_DF_FILE, index=False)
+
+def report_startup():
+    # Fixed cost of a run before any game is scraped; browser start is summed over the pool's drivers
+    stages = {'imports': IMPORT_SECONDS,
+              **{stage: METRICS.stage_seconds(stage) for stage in ('driver_resolve', 'browser_start', 'login')}}
+    print(f"Startup in {time.perf_counter() - STARTED:.2f}s: " +
+          ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in stages.items()))
+
+
+def scheduled_job(lean=LEAN_BROWSER, backend=FETCH_BACKEND):
+    scrape_ts = datetime.now(pytz.utc)
+    overview = OverviewTracker.load(refresh_seconds=TRENDS_REFRESH)
+    # All markets share the notified movements, loaded once and written once
+    notified_movements = NotifiedStore.load()
+    # With a bot token alerts go out as each game is scraped, otherwise they are left in messages.txt
+    outbox = open_outbox()
+    history = HistoryWriter()
+    # Nothing stays in memory between cron runs, the steam window is rebuilt from the stored scrapes; one
+    # window more so every quote has a reference at least STEAM_MINUTES old
+    tracker = MovementTracker.from_history(scrape_ts - timedelta(minutes=2 * STEAM_MINUTES), STEAM_MARKETS)
+    games = {}
+    selected_urls = []
+    messages = []
+
+    # Cheap first pass on the overview table, then deep scrape only the games whose lines moved
+    session = make_session(backend, lean)
+    try:
+        session.start()
+        report_startup()
+        game_urls, fingerprints = session.read_overview()
+        selected_urls = overview.select(fingerprints, scrape_ts)
+        print(f"Deep scraping {len(selected_urls)} of {len(game_urls)} games")
+        # The previous poll of every game comes from the odds history
+        for url, game, new, message in stream_messages(session, selected_urls, scrape_ts, previous_snapshots,
+                                                       notified_movements, BestPriceIndex()):
+            games[url] = game
+            steam = steam_message(tracker, new, scrape_ts, notified_movements)
+            message = '\n\n'.join(part for part in (message, steam) if part)
+            if message and outbox:
+                outbox.submit(message)
+            elif message:
+                messages.append(message)
+        failed_urls = session.failed_urls
+    finally:
+        session.close()
+        notified_movements.flush()
+        # Every scrape is appended to the history, nothing is overwritten
+        history.submit(combine_game_results(in_url_order(games, selected_urls), scrape_ts), scrape_ts)
+        if outbox:
+            outbox.close()
+            # Alerts a chat did not take are left for the send step, per chat
+            outbox.save_unsent()
+        history.close()
+        # save messages for sending, also those of the games scraped before a failure
+        save_messages(messages)
+
+    for url in selected_urls:
+        if url not in failed_urls:
+            overview.record(url, fingerprints[url], scrape_ts)
+    overview.forget_missing(fingerprints)
+    overview.save()
+    METRICS.flush_cycle(mode='cron')
+
+
+class Daemon:
+    # Keeps one logged-in session, the previous poll and the notified movements in memory between polls
+
+    def __init__(self, session, outbox=None):
+        self.session = session
+        self.notified_movements = NotifiedStore.load()
+        self.previous = {market: remove_past_events(read_latest_quotes(market)) for market in MARKETS}
+        # Last quotes of every book beyond the previous poll, restored from the last checkpoint
+        self.tracker = MovementTracker.load()
+        # Current price of every book, updated game by game
+        self.prices = BestPriceIndex()
+        # One Telegram client on a background loop, alerts are handed over without blocking the next game
+        self.outbox = outbox
+        # and one writer thread, the parquet writes of a poll overlap the next one
+        self.history = HistoryWriter()
+        self.polling = TipoffScheduler()
+        # The tipoff scheduler already refreshes the trends of every game on its own schedule
+        self.overview = OverviewTracker(refresh_seconds=None)
+
+    def poll(self):
+        # Run by schedule, an exception leaving it would stop the daemon: every failure ends here and the next
+        # poll starts over
+        try:
+            self.poll_games()
+        except Exception:
+            print("Poll failed:")
+            traceback.print_exc()
+            METRICS.increment('poll_errors')
+            METRICS.flush_cycle(mode='daemon')
+
+    def poll_games(self):
+        session, previous, notified_movements = self.session, self.previous, self.notified_movements
+        polling, overview, tracker = self.polling, self.overview, self.tracker
+        scrape_ts = datetime.now(pytz.utc)
+        games = {}
+        due_urls = []
+        notified_movements.evict_past_events()
+        try:
+            game_urls, fingerprints = session.read_overview()
+            polling.sync(game_urls, scrape_ts)
+            # Games whose overview lines moved go first, then the ones due by their tipoff schedule
+            changed_urls = [url for url in overview.select(fingerprints, scrape_ts) if url not in polling.retired]
+            due_urls = changed_urls + [url for url in polling.due(scrape_ts) if url not in changed_urls]
+            due_urls = due_urls[:GAMES_PER_POLL] if GAMES_PER_POLL else due_urls
+            for url, game, new, message in stream_messages(session, due_urls, scrape_ts, lambda new: previous,
+                                                           notified_movements, self.prices):
+                games[url] = game
+                if url not in session.failed_urls:
+                    polling.record(url, game['time'] if game else None, scrape_ts)
+                    overview.record(url, fingerprints[url], scrape_ts)
+                # Only the games polled this time are replaced in the previous state
+                for market in MARKETS:
+                    previous[market] = update_quotes(previous[market], new[market])
+                steam = steam_message(tracker, new, scrape_ts, notified_movements)
+                message = '\n\n'.join(part for part in (message, steam) if part)
+                if message and self.outbox:
+                    self.outbox.submit(message)
+                elif message:
+                    print("TELEGRAM_BOT_TOKEN is not set, alerts are not sent.")
+        except session.errors as e:
+            # Crashed browser or broken login, start over on the next poll
+            print(f"Scrape failed, restarting the session: {e}")
+            METRICS.increment('driver_restarts')
+            self.restart_session()
+            METRICS.flush_cycle(mode='daemon')
+            return
+        finally:
+            # The games scraped before any failure are kept, whatever ended the poll
+            self.checkpoint(in_url_order(games, due_urls), scrape_ts)
+
+        overview.forget_missing(fingerprints)
+        report = polling.report(datetime.now(pytz.utc))
+        most_behind = max(report['lag'].items(), key=lambda item: item[1], default=None)
+        print(f"Polled {len(due_urls)} of {report['tracked']} games in "
+              f"{(datetime.now(pytz.utc) - scrape_ts).total_seconds():.1f}s, queue depth {report['queue_depth']}"
+              + (f", most behind {most_behind[0]} by {most_behind[1]:.0f}s" if most_behind else ""))
+        METRICS.flush_cycle(mode='daemon')
+
+    def restart_session(self):
+        # A restart that fails (browser start, login timeout) is retried by the next poll's read_overview
+        try:
+            self.session.restart()
+        except Exception as e:
+            print(f"Session restart failed, retrying on the next poll: {e!r}")
+            METRICS.increment('restart_failures')
+
+    def checkpoint(self, games, scrape_ts):
+        self.history.submit(combine_game_results(games, scrape_ts), scrape_ts)
+        self.notified_movements.flush()
+        # Alerts a chat did not take go to the unsent file, where the sender picks them up
+        if self.outbox:
+            self.outbox.save_unsent()
+        for market in MARKETS:
+            self.previous[market] = remove_past_events(self.previous[market])
+        self.tracker.evict_started()
+        self.prices.evict_started()
+        self.tracker.save()
+
+    def close(self):
+        if self.outbox:
+            self.outbox.close()
+        self.history.close()
+        self.session.close()
+
+
+def run_daemon(interval=POLL_INTERVAL, lean=LEAN_BROWSER, backend=FETCH_BACKEND):
+    session = make_session(backend, lean).start()
+    report_startup()
+    daemon = Daemon(session, open_outbox())
+    schedule.every(interval).seconds.do(daemon.poll)
+    try:
+        daemon.poll()
+        while True:
+            schedule.run_pending()
+            time.sleep(min(1, interval))
+    finally:
+        daemon.close()
 
 
 # Execute the scheduler in a loop
 if __name__ == "__main__":
-    scheduled_job()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep a logged-in browser warm and poll on an in-process schedule')
+    parser.add_argument('--interval', type=int, default=POLL_INTERVAL, help='seconds between polls in daemon mode')
+    parser.add_argument('--lean', action='store_true', default=LEAN_BROWSER,
+                        help='block images, fonts, ads and trackers and do not wait for them to load')
+    parser.add_argument('--backend', choices=('browser', 'http'), default=FETCH_BACKEND,
+                        help='fetch pages with Chromium or over plain HTTP (the browser only logs in and fills gaps)')
+    args = parser.parse_args()
+    if args.daemon:
+        run_daemon(args.interval, args.lean, args.backend)
+    else:
+        scheduled_job(args.lean, args.backend)